@@ -3,13 +3,12 @@ import pandas as pd
 import folium
 from streamlit_folium import st_folium
 import logging
+import os
 from datetime import datetime
 
-import user_patterns as up
-import sl_rtd as sl
-import trajectory_map as tm
-import user_trajectories as ut
-import lbrp as lbrp
+import pipeline
+import storage
+import heatmap as hm
 
 # __Author__: pablo-chacon
 # __Version__: 1.0.2
@@ -19,23 +18,31 @@ import lbrp as lbrp
 logging.basicConfig(level=logging.INFO)
 
 
-# Run scripts, generate data.
-def run_scripts():
-    ut.user_trajectory()  # Generate user trajectories first
-    lbrp.lbrp()  # Then generate the optimized route
-    up.user_patterns()  # Generate user patterns
-    sl.rtd()  # Load real-time data
-    tm.create_trajectory_map()  # Create trajectory map
+# Run scripts, generate data. Stages whose inputs are unchanged are skipped.
+def run_scripts(force=False):
+    return pipeline.run_pipeline(force=force)
 
 
-# Load data functions
+# Prepare data once per process; reruns of the page only read the artefacts.
+@st.cache_resource(ttl=int(os.getenv('PIPELINE_REFRESH_SECONDS', 15 * 60)))
+def prepare_data():
+    return run_scripts()
+
+
+# Load data functions. Accepts a .pkl file or the name of a stored table.
+def load_data(file_path, columns=None):
+    path = file_path if file_path.endswith('.pkl') else storage.table_path(file_path)
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    return _load_data(file_path, mtime, tuple(columns) if columns else None)
+
+
+# Cached per file version, so rewritten artefacts are picked up.
 @st.cache_data
-def load_data(file_path):
+def _load_data(file_path, mtime, columns):
     try:
-        data = pd.read_pickle(file_path)
-        if isinstance(data, list):  # Check if data is a list
-            data = pd.DataFrame(data)
-        return data
+        if file_path.endswith('.pkl'):
+            return pd.read_pickle(file_path)
+        return storage.load_table(file_path, columns=list(columns) if columns else None)
     except Exception as e:
         st.error(f"Error loading {file_path}: {e}")
         return None
@@ -51,43 +58,104 @@ def calculate_total_transit_time(data, time_column='waypoint_time'):
     return None
 
 
-# Create folium map from DataFrame.
+# Column schemas a map can be built from: (latitude, longitude, popup fields).
+MAP_SCHEMAS = [
+    ('Latitude', 'Longitude', ['user_id', 'Time']),
+    ('lat', 'lon', ['name', 'note']),
+    ('waypoint_lat', 'waypoint_lon', ['site_name', 'waypoint_time']),
+]
+
+
+# First schema whose coordinate columns are present, or None.
+def detect_schema(data):
+    for lat, lon, fields in MAP_SCHEMAS:
+        if lat in data.columns and lon in data.columns:
+            return lat, lon, [field for field in fields if field in data.columns]
+    return None
+
+
+# Point features with the popup fields as string properties, cached on the data hash.
+def map_features(data, lat, lon, fields):
+    data_hash = int(pd.util.hash_pandas_object(data[[lat, lon] + fields], index=False).sum())
+    return _map_features(data_hash, data, lat, lon, tuple(fields))
+
+
+@st.cache_data(max_entries=16)
+def _map_features(data_hash, _data, lat, lon, fields):
+    data = _data.dropna(subset=[lat, lon])
+    coords = data[[lon, lat]].to_numpy(dtype=float).tolist()
+    properties = data[list(fields)].astype(str).to_dict('records')
+    features = [{'type': 'Feature', 'properties': props, 'geometry': {'type': 'Point', 'coordinates': xy}}
+                for xy, props in zip(coords, properties)]
+    center = [data[lat].mean(), data[lon].mean()]
+    return {'type': 'FeatureCollection', 'features': features}, center
+
+
+# Create folium map from DataFrame: all rows as one GeoJSON layer with popups.
 def create_folium_map(data, title, color='blue'):
-    if 'Latitude' in data.columns and 'Longitude' in data.columns:
-        m = folium.Map(location=[data['Latitude'].mean(), data['Longitude'].mean()], zoom_start=15)
-        for _, row in data.iterrows():
-            folium.Marker(
-                location=[row['Latitude'], row['Longitude']],
-                popup=f"{row['user_id']}<br>Time: {row['Time']}",
-                icon=folium.Icon(color=color)
-            ).add_to(m)
-    elif 'lat' in data.columns and 'lon' in data.columns:
-        # Filter out rows with NaN values in 'lat' or 'lon'
-        data = data.dropna(subset=['lat', 'lon'])
-        m = folium.Map(location=[data['lat'].mean(), data['lon'].mean()], zoom_start=15)
-        for _, row in data.iterrows():
-            folium.Marker(
-                location=[row['lat'], row['lon']],
-                popup=f"{row['name']}<br>Note: {row['note']}",
-                icon=folium.Icon(color=color)
-            ).add_to(m)
-    elif 'waypoint_lat' in data.columns and 'waypoint_lon' in data.columns:
-        m = folium.Map(location=[data['waypoint_lat'].mean(), data['waypoint_lon'].mean()], zoom_start=15)
-        for _, row in data.iterrows():
-            folium.Marker(
-                location=[row['waypoint_lat'], row['waypoint_lon']],
-                popup=f"{row['site_name']}<br>Time: {row['waypoint_time']}",
-                icon=folium.Icon(color=color)
-            ).add_to(m)
-    else:
+    schema = detect_schema(data)
+    if schema is None:
         st.error(
             f"Data for {title} does not contain 'Latitude'/'Longitude', 'lat'/'lon', or 'waypoint_lat'/'waypoint_lon' columns."
         )
         return None
+    lat, lon, fields = schema
+    features, center = map_features(data, lat, lon, fields)
+    m = folium.Map(location=center, zoom_start=15)
+    folium.GeoJson(
+        features,
+        name=title,
+        marker=folium.Marker(icon=folium.Icon(color=color)),
+        popup=folium.GeoJsonPopup(fields=fields) if fields else None,
+    ).add_to(m)
     folium.LayerControl().add_to(m)
     return m
 
 
+# Heatmap cells in view, cached per zoom level, cell range and table version.
+def load_heatmap_cells(zoom, bounds):
+    path = storage.table_path(hm.HEATMAP_TABLE)
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    zoom = hm.clamp_zoom(zoom)
+    return _load_heatmap_cells(zoom, hm.cell_range(bounds, zoom) if bounds else None, mtime)
+
+
+@st.cache_data
+def _load_heatmap_cells(zoom, cell_range, mtime):
+    return hm.query_cell_range(zoom, cell_range)
+
+
+# Level-of-detail density map: only the cells of the current zoom level inside the
+# viewport are sent, and the layer is replaced in place as the user pans and zooms.
+def display_heatmap(key='patterns_heatmap'):
+    view = st.session_state.get(key) or {}
+    zoom = view.get('zoom')
+    bounds = view.get('bounds')
+    if zoom is None or not bounds or not bounds.get('_southWest'):
+        zoom = hm.HEATMAP_START_ZOOM
+        cells = load_heatmap_cells(zoom, None)
+        if cells.empty:
+            st.write("No heatmap cells.")
+            return None
+        center = [cells['lat'].mean(), cells['lon'].mean()]
+    else:
+        sw, ne = bounds['_southWest'], bounds['_northEast']
+        cells = load_heatmap_cells(zoom, (sw['lat'], sw['lng'], ne['lat'], ne['lng']))
+        center = [view['center']['lat'], view['center']['lng']]
+
+    m = folium.Map(location=center, zoom_start=zoom)
+    layer = folium.FeatureGroup(name='Density')
+    if not cells.empty:
+        folium.GeoJson(
+            hm.cells_geojson(cells),
+            style_function=lambda feature: {'fillColor': 'red', 'color': 'red', 'weight': 0,
+                                            'fillOpacity': 0.15 + 0.65 * feature['properties']['intensity']},
+            tooltip=folium.GeoJsonTooltip(fields=['count'], aliases=['Points']),
+        ).add_to(layer)
+    return st_folium(m, center=center, zoom=zoom, feature_group_to_add=layer, key=key, width=700,
+                     returned_objects=['zoom', 'bounds', 'center'])
+
+
 # Display folium map from HTML.
 def display_map(html_file_path):
     with open(html_file_path, 'r') as file:
@@ -96,7 +164,7 @@ def display_map(html_file_path):
 
 
 # Generate data
-run_scripts()
+prepare_data()
 
 # Streamlit UI
 st.title("User Trajectories and Optimization Visualization")
@@ -104,7 +172,7 @@ st.title("User Trajectories and Optimization Visualization")
 tab1, tab2, tab3, tab4 = st.tabs(["User Trajectories", "Real-Time Data", "Optimization Comparison", "User Patterns"])
 
 with tab1:
-    all_user_data = load_data("all_user_data.pkl")
+    all_user_data = load_data("all_user_data", columns=['Latitude', 'Longitude', 'Time', 'user_id'])
     st.header("User Trajectories")
     st.write(all_user_data.head())
     st.header("Trajectory Map")
@@ -118,9 +186,8 @@ with tab2:
     st.write("Deviations Data", deviations_data.head())
 
 with tab3:
-    optimized_data = load_data("optimized_route.pkl")
+    optimized_data = load_data("optimized_route", columns=['waypoint_lat', 'waypoint_lon', 'waypoint_time', 'site_name'])
     if optimized_data is not None:
-        original_data = load_data("gdf.pkl")
         st.header("Optimization Comparison")
 
         # Before Optimization
@@ -141,4 +208,7 @@ with tab3:
 
 with tab4:
     st.header("User Patterns")
-    display_map("user_patterns_map.html")
+    if storage.table_exists(hm.HEATMAP_TABLE):
+        display_heatmap()
+    else:
+        display_map("user_patterns_map.html")
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import regen_trajectories as regen
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""Benchmarks for the pipeline stages.
+    Generates a synthetic fleet (GPX files from regen_trajectories) and a synthetic sites catalogue, runs
+    each stage in its own process against a stubbed SL API, and writes wall time,
+    peak memory and throughput per stage to a JSON file.
+
+    python benchmark.py --users 10 100 1000 --hours 48 --output benchmark_results.json
+    python benchmark.py --users 100 --compare baseline.json
+    python benchmark.py --users 100 --archive sl_archive.jsonl.gz --latency-ms 80 --error-rate 0.02"""
+
+BENCHMARK_FILE = 'benchmark_results.json'
+STAGE_ORDER = ['rtd', 'user_trajectory', 'lbrp', 'user_patterns', 'heatmap', 'trajectory_map']
+CENTER_LAT, CENTER_LON = 59.3293, 18.0686  # Stockholm
+
+
+# Write the fleet as one GPX file per user. Returns the number of points.
+def write_fleet(folder, n_users, hours, interval_s=600, seed=0):
+    return regen.generate(n_users, days=hours / 24, interval_s=interval_s, seed=seed, output=folder, fmt='gpx')
+
+
+# Sites catalogue records in the layout of the SL sites endpoint.
+def synthetic_sites(n_sites, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = CENTER_LAT + rng.uniform(-0.15, 0.15, n_sites)
+    lon = CENTER_LON + rng.uniform(-0.25, 0.25, n_sites)
+    return [{'id': 1000 + i, 'gid': 9091001000000000 + 1000 + i, 'name': f'Site {i}', 'note': None,
+             'lat': float(lat[i]), 'lon': float(lon[i]), 'valid': {'from': '2012-06-23T00:00:00'},
+             'abbreviation': None, 'alias': None} for i in range(n_sites)]
+
+
+# Departures for a site: n departures, 5 minutes apart from now, with a random delay.
+def synthetic_departures(site_id, n=4):
+    rng = np.random.default_rng(int(site_id))
+    now = pd.Timestamp.now().floor('min')
+    departures = []
+    for k in range(n):
+        scheduled = now + pd.Timedelta(minutes=5 * (k + 1))
+        expected = scheduled + pd.Timedelta(seconds=int(rng.integers(0, 300)))
+        line = int(rng.integers(1, 20))
+        departures.append({'destination': f'Destination {line}', 'direction': 'Outbound', 'state': 'EXPECTED',
+                           'scheduled': scheduled.isoformat(), 'expected': expected.isoformat(),
+                           'line': {'id': line, 'designation': str(line), 'transport_mode': 'BUS'}})
+    return departures
+
+
+class _StubResponse:
+    def __init__(self, payload):
+        self.status_code = 200
+        self.content = json.dumps(payload).encode()
+        self.text = ''
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+# Replace the SL HTTP calls with synthetic sites, deviations and departures.
+@contextlib.contextmanager
+def stub_sl_api(sites):
+    import sl_rtd as sl
+
+    def make_request(url, params=None, timeout=None):
+        if url == sl.deviations_url:
+            return [{'version': 1, 'deviation_case_id': i, 'priority': {'importance_level': 1}} for i in range(10)]
+        site_id = url.rstrip('/').split('/')[-2]
+        return {'departures': synthetic_departures(site_id)}
+
+    def make_conditional_request(url, etag=None, last_modified=None, timeout=None):
+        return _StubResponse(sites)
+
+    original = sl.make_request, sl.make_conditional_request
+    sl.make_request, sl.make_conditional_request = make_request, make_conditional_request
+    try:
+        yield
+    finally:
+        sl.make_request, sl.make_conditional_request = original
+
+
+# Serve the SL API from a recorded archive (see sl_transport) with simulated latency/errors.
+@contextlib.contextmanager
+def replay_sl_api(archive, latency_ms=0.0, error_rate=0.0, seed=0):
+    import sl_rtd as sl
+    import sl_transport
+    previous = sl.set_transport(sl_transport.ReplayTransport(archive, latency_ms=latency_ms, error_rate=error_rate,
+                                                             seed=seed))
+    try:
+        yield
+    finally:
+        sl.set_transport(previous)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    unit = 1 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak * unit / 2 ** 20
+
+
+# Run one stage in the current (fresh) process and measure it.
+# replay: None for the synthetic stub, else replay_sl_api keyword arguments.
+def _run_stage(stage, workdir, fleet_dir, n_sites, seed, replay=None):
+    os.chdir(workdir)
+    import user_trajectories as ut
+    import lbrp
+    import user_patterns as up
+    import heatmap as hm
+    import sl_rtd as sl
+    import trajectory_map as tm
+    import metrics
+    funcs = {
+        'rtd': sl.rtd,
+        'user_trajectory': lambda: ut.user_trajectory(gpx_folder=fleet_dir),
+        'lbrp': lbrp.lbrp,
+        'user_patterns': up.user_patterns,
+        'heatmap': hm.heatmap,
+        'trajectory_map': tm.create_trajectory_map,
+    }
+    baseline = _peak_rss_mb()
+    api = replay_sl_api(seed=seed, **replay) if replay else stub_sl_api(synthetic_sites(n_sites, seed))
+    with api, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        funcs[stage]()
+        wall = time.perf_counter() - start
+    counters = metrics.registry.snapshot()['counters']
+    result = {'stage': stage, 'wall_s': wall, 'baseline_rss_mb': baseline, 'peak_rss_mb': _peak_rss_mb(),
+              'counters': counters}
+    if stage == 'lbrp':
+        result['waypoints'] = sum(c['value'] for c in counters if c['name'] == 'waypoints_queried_total')
+    return result
+
+
+# Benchmark the stages for one fleet size. Each stage runs in a new process so its
+# peak memory is its own; stages share a working directory, so each sees the
+# outputs of the previous ones. Stages before the last selected one always run
+# (to produce its inputs) but only the selected ones are reported.
+def run_case(n_users, hours, interval_s=600, n_sites=2000, stages=STAGE_ORDER, seed=0, keep=False, replay=None):
+    workdir = tempfile.mkdtemp(prefix='lbrp_bench_')
+    fleet_dir = os.path.join(workdir, 'user_profiles')
+    points = write_fleet(fleet_dir, n_users, hours, interval_s, seed)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        last = max(STAGE_ORDER.index(name) for name in stages)
+        for stage in STAGE_ORDER[:last + 1]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_stage, stage, workdir, fleet_dir, n_sites, seed, replay).result()
+            if stage not in stages:
+                continue
+            result.update(users=n_users, hours=hours, interval_s=interval_s, sites=n_sites, points=points,
+                          points_per_s=points / result['wall_s'])
+            if result.get('waypoints') is not None:
+                result['waypoints_per_s'] = result['waypoints'] / result['wall_s']
+            print(f"{stage:16s} users={n_users:<7d} points={points:<9d} {result['wall_s']:8.2f} s "
+                  f"{result['peak_rss_mb']:8.1f} MB {result['points_per_s']:12.0f} points/s")
+            results.append(result)
+    finally:
+        if keep:
+            print(f"Benchmark files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(users=(10, 100), hours=(48,), interval_s=600, n_sites=2000, stages=STAGE_ORDER, seed=0,
+                   output=BENCHMARK_FILE, keep=False, replay=None):
+    results = []
+    for n_users in users:
+        for n_hours in hours:
+            results.extend(run_case(n_users, n_hours, interval_s, n_sites, stages, seed, keep, replay))
+    report = {'commit': _git_commit(), 'created': datetime.now(timezone.utc).isoformat(),
+              'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+              'results': results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    return report
+
+
+# Wall time ratio (current / baseline) per stage and fleet size; ratios above
+# 1 + threshold are reported as regressions.
+def compare_results(baseline, current, threshold=0.2):
+    def key(result):
+        return result['stage'], result['users'], result['hours'], result['interval_s']
+
+    before = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        ratio = result['wall_s'] / old['wall_s']
+        flag = 'REGRESSION' if ratio > 1 + threshold else ''
+        print(f"{result['stage']:16s} users={result['users']:<7d} {old['wall_s']:8.2f} s -> "
+              f"{result['wall_s']:8.2f} s  x{ratio:5.2f}  {flag}")
+        if flag:
+            regressions.append({'stage': result['stage'], 'users': result['users'], 'ratio': ratio})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--hours', type=float, nargs='+', default=[48])
+    parser.add_argument('--interval', type=int, default=600, help="seconds between points")
+    parser.add_argument('--sites', type=int, default=2000)
+    parser.add_argument('--stages', nargs='+', default=STAGE_ORDER, choices=STAGE_ORDER)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=BENCHMARK_FILE)
+    parser.add_argument('--compare', help="baseline results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed slowdown before a regression")
+    parser.add_argument('--keep', action='store_true', help="keep the generated working directories")
+    parser.add_argument('--archive', help="replay this recorded SL archive instead of the synthetic stub")
+    parser.add_argument('--latency-ms', default='0', help="median replay latency, or 'recorded'")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of replayed requests that fail")
+    args = parser.parse_args(argv)
+
+    replay = None
+    if args.archive:
+        latency = args.latency_ms if args.latency_ms == 'recorded' else float(args.latency_ms)
+        replay = {'archive': os.path.abspath(args.archive), 'latency_ms': latency, 'error_rate': args.error_rate}
+    report = run_benchmarks(args.users, args.hours, args.interval, args.sites, args.stages, args.seed,
+                            args.output, args.keep, replay)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), report, args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
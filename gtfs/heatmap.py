@@ -0,0 +1,118 @@
+import os
+import numpy as np
+import pandas as pd
+import storage
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""Level-of-detail density grid for the user patterns view.
+    Points are counted into square web-mercator cells of CELL_PX screen pixels at
+    every zoom level between HEATMAP_MIN_ZOOM and HEATMAP_MAX_ZOOM, stored once as
+    the heatmap_cells table (partitioned by zoom). A view reads only the cells of
+    its zoom level inside the viewport, so its size is bounded by the screen, not
+    by the number of points."""
+
+HEATMAP_TABLE = 'heatmap_cells'
+HEATMAP_MIN_ZOOM = int(os.getenv('HEATMAP_MIN_ZOOM', 8))
+HEATMAP_MAX_ZOOM = int(os.getenv('HEATMAP_MAX_ZOOM', 17))
+HEATMAP_START_ZOOM = 12
+CELL_PX = 16
+TILE_PX = 256
+MAX_LAT = 85.05112878
+
+
+# Web-mercator pixel coordinates at a zoom level.
+def to_pixels(lat, lon, zoom):
+    scale = TILE_PX * 2.0 ** zoom
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -MAX_LAT, MAX_LAT))
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * scale
+    return x, y
+
+
+def from_pixels(x, y, zoom):
+    scale = TILE_PX * 2.0 ** zoom
+    lon = np.asarray(x, dtype=float) / scale * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * np.asarray(y, dtype=float) / scale))))
+    return lat, lon
+
+
+# Count points per cell at every zoom level. Counts are taken at the finest level and
+# summed into the coarser ones (a cell at zoom z - 1 covers 2 x 2 cells at zoom z).
+def build_heatmap_cells(df, min_zoom=HEATMAP_MIN_ZOOM, max_zoom=HEATMAP_MAX_ZOOM):
+    df = df.dropna(subset=['Latitude', 'Longitude'])
+    x, y = to_pixels(df['Latitude'].to_numpy(), df['Longitude'].to_numpy(), max_zoom)
+    cells = pd.DataFrame({'cx': (x // CELL_PX).astype('int64'), 'cy': (y // CELL_PX).astype('int64')})
+    cells = cells.groupby(['cx', 'cy']).size().rename('count').reset_index()
+
+    levels = []
+    for zoom in range(max_zoom, min_zoom - 1, -1):
+        if zoom < max_zoom:
+            cells = cells.assign(cx=cells['cx'] // 2, cy=cells['cy'] // 2)
+            cells = cells.groupby(['cx', 'cy'], as_index=False)['count'].sum()
+        lat, lon = from_pixels((cells['cx'] + 0.5) * CELL_PX, (cells['cy'] + 0.5) * CELL_PX, zoom)
+        levels.append(cells.assign(lat=lat, lon=lon, zoom=zoom))
+    if not levels:
+        return pd.DataFrame(columns=['cx', 'cy', 'count', 'lat', 'lon', 'zoom'])
+    return pd.concat(levels, ignore_index=True)
+
+
+# Cell index range covering the bounds (south, west, north, east) at a zoom level.
+def cell_range(bounds, zoom):
+    south, west, north, east = bounds
+    x0, y0 = to_pixels(north, west, zoom)
+    x1, y1 = to_pixels(south, east, zoom)
+    return int(x0 // CELL_PX), int(y0 // CELL_PX), int(x1 // CELL_PX), int(y1 // CELL_PX)
+
+
+def clamp_zoom(zoom):
+    return int(min(max(round(zoom), HEATMAP_MIN_ZOOM), HEATMAP_MAX_ZOOM))
+
+
+# Cells of the (clamped) zoom level inside the bounds; all cells of the level if bounds is None.
+def query_cells(zoom, bounds=None):
+    zoom = clamp_zoom(zoom)
+    return query_cell_range(zoom, cell_range(bounds, zoom) if bounds is not None else None)
+
+
+# Cells of a zoom level within a (cx0, cy0, cx1, cy1) index range. Both the zoom and
+# the range are pushed down to the Parquet reader.
+def query_cell_range(zoom, cells=None):
+    filters = [('zoom', '=', zoom)]
+    if cells is not None:
+        cx0, cy0, cx1, cy1 = cells
+        filters += [('cx', '>=', cx0), ('cx', '<=', cx1), ('cy', '>=', cy0), ('cy', '<=', cy1)]
+    found = storage.load_table(HEATMAP_TABLE, columns=['cx', 'cy', 'count', 'lat', 'lon'], filters=filters)
+    return found.assign(zoom=zoom)
+
+
+# Cell rectangles as a GeoJSON FeatureCollection. Properties hold the count and an
+# intensity in [0, 1] (log count relative to the densest cell in the set).
+def cells_geojson(cells):
+    zoom = int(cells['zoom'].iloc[0]) if len(cells) else HEATMAP_MAX_ZOOM
+    lat0, lon0 = from_pixels(cells['cx'] * CELL_PX, cells['cy'] * CELL_PX, zoom)
+    lat1, lon1 = from_pixels((cells['cx'] + 1) * CELL_PX, (cells['cy'] + 1) * CELL_PX, zoom)
+    log_count = np.log1p(cells['count'].to_numpy(dtype=float))
+    intensity = log_count / log_count.max() if len(cells) else log_count
+    features = []
+    for count, level, a, b, c, d in zip(cells['count'].tolist(), intensity.round(3).tolist(), lat0.tolist(),
+                                        lon0.tolist(), lat1.tolist(), lon1.tolist()):
+        ring = [[b, a], [d, a], [d, c], [b, c], [b, a]]
+        features.append({'type': 'Feature', 'properties': {'count': count, 'intensity': level},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def heatmap(df=None):
+    if df is None:
+        df = storage.load_table('all_user_data', columns=['Latitude', 'Longitude'])
+    cells = build_heatmap_cells(df)
+    storage.save_table(cells, HEATMAP_TABLE)
+    print(f"Heatmap: {len(cells)} cells over zoom {HEATMAP_MIN_ZOOM}-{HEATMAP_MAX_ZOOM}")
+    return cells
+
+
+if __name__ == '__main__':
+    heatmap()
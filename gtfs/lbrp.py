@@ -1,13 +1,17 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point
 from dotenv import load_dotenv
 import os
-from geopy.distance import geodesic
 import sl_rtd as sl
+import stop_index as si
+import storage
+import metrics
+from metrics import payload_log
+from user_trajectories import haversine_np
 import logging
-import pickle
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 # __Author__: pablo-chacon
 # __Version__: 1.0.2
@@ -28,16 +32,15 @@ def load_sites_data():
     return sl.load_sites_data()
 
 
+# Load the spatial index over the sites data.
+def load_sites_index(sites_data=None):
+    return sl.load_sites_index(sites_data)
+
+
 # Find the three closest sites within 1 km.
 def find_nearby_sites(lat, lon, sites_data, radius=1000, n=3):
-    user_location = (lat, lon)
-    sites_data = sites_data.dropna(subset=['lat', 'lon'])  # Ensure no NaNs in coordinates
-    logging.info(f"User location: {user_location}")
-    sites_data['distance'] = sites_data.apply(lambda row: geodesic(user_location, (row['lat'], row['lon'])).meters,
-                                              axis=1)
-    nearby_sites = sites_data[sites_data['distance'] <= radius]
-    closest_sites = nearby_sites.nsmallest(n, 'distance')
-    return closest_sites
+    logging.info(f"User location: {(lat, lon)}")
+    return si.as_index(sites_data).nearest(lat, lon, k=n, radius=radius)
 
 
 # Fetch real-time departure information.
@@ -45,121 +48,271 @@ def fetch_departures(site_id, time_window=10):
     try:
         departures = sl.fetch_departures(site_id, time_window)
         if departures:
-            logging.info(f"Fetched departures for site ID {site_id}: {departures}")
+            payload_log.debug("Fetched departures for site ID %s: %s", site_id, departures)
             return departures  # Return all departures without filtering.
     except Exception as e:
         logging.error(f"Error fetching departures for site ID {site_id}: {e}")
     return []
 
 
+# Fetch real-time departures for many sites concurrently.
+def fetch_departures_many(site_ids, time_window=10):
+    try:
+        departures = sl.fetch_departures_many(site_ids, time_window)
+        logging.info(f"Fetched departures for {len(departures)} sites")
+        return departures
+    except Exception as e:
+        logging.error(f"Error fetching departures for {len(site_ids)} sites: {e}")
+    return {}
+
+
+# Average speeds (km/h) for travel without public transport.
+TRAVEL_SPEEDS_KMH = {
+    'walk': 5,  # Average walking speed
+    'bike': 15,  # Average biking speed
+    'car': 50,  # Average city driving speed
+}
+
+# Route every waypoint by default; a larger step samples every n-th waypoint.
+WAYPOINT_STEP = int(os.getenv('LBRP_WAYPOINT_STEP', 1))
+
+# Columns of the flat optimized route table.
+ROUTE_COLUMNS = ['waypoint_lat', 'waypoint_lon', 'waypoint_time', 'site_id', 'site_name', 'site_lat', 'site_lon',
+                 'destination', 'direction', 'state', 'scheduled', 'expected', 'line_id', 'line_designation',
+                 'transport_mode']
+ROUTE_CATEGORIES = ['destination', 'direction', 'state', 'line_designation', 'transport_mode']
+
+
 # Estimate travel time walking/biking/driving.
 def estimate_travel_time(distance, transport_mode):
-    if transport_mode == 'walk':
-        speed_kmh = 5  # Average walking speed
-    elif transport_mode == 'bike':
-        speed_kmh = 15  # Average biking speed
-    elif transport_mode == 'car':
-        speed_kmh = 50  # Average city driving speed
-    else:
+    if transport_mode not in TRAVEL_SPEEDS_KMH:
         return "N/A"
-    travel_time_hours = distance / 1000 / speed_kmh
+    travel_time_hours = distance / 1000 / TRAVEL_SPEEDS_KMH[transport_mode]
     travel_time_minutes = travel_time_hours * 60
     return timedelta(minutes=travel_time_minutes)
 
 
-# Optimize route.
-def optimize_route(gdf, sites_data, destination_coords, step=15):
-    route = []
-    for i in range(0, len(gdf), step):
-        waypoint = gdf.iloc[i]
-        if pd.isna(waypoint['Latitude']) or pd.isna(waypoint['Longitude']):
-            logging.warning(f"Skipping waypoint with NaN coordinates at index {i}")
-            continue
-        closest_sites = find_nearby_sites(waypoint['Latitude'], waypoint['Longitude'], sites_data)
-        logging.info(
-            f"Closest sites for waypoint {i} ({waypoint['Latitude']}, {waypoint['Longitude']}): {closest_sites}")
-        if not closest_sites.empty:
-            for _, site in closest_sites.iterrows():
-                departures = fetch_departures(site['id'])
-                if departures:  # Only add entries with departures
-                    logging.info(f"Found departures for site ID {site['id']} at waypoint {i}")
-                    for dep in departures:
-                        route.append({
-                            "waypoint_lat": waypoint['Latitude'],
-                            "waypoint_lon": waypoint['Longitude'],
-                            "waypoint_time": waypoint['Time'],
-                            "site_id": site['id'],
-                            "site_name": site['name'],
-                            "site_lat": site['lat'],
-                            "site_lon": site['lon'],
-                            "destination": dep['destination'],
-                            "direction": dep['direction'],
-                            "state": dep['state'],
-                            "scheduled": dep['scheduled'],
-                            "expected": dep['expected'],
-                            "line_id": dep['line']['id'],
-                            "line_designation": dep['line']['designation'],
-                            "transport_mode": dep['line']['transport_mode']
-                        })
-        else:
-            # Handle case with no nearby sites
-            logging.info(f"No nearby sites found for waypoint {i} ({waypoint['Latitude']}, {waypoint['Longitude']})")
-            for dest_lat, dest_lon in destination_coords:
-                distance = geodesic((waypoint['Latitude'], waypoint['Longitude']), (dest_lat, dest_lon)).meters
-                for mode in ['walk', 'bike', 'car']:
-                    eta = estimate_travel_time(distance, mode)
-                    route.append({
-                        "waypoint_lat": waypoint['Latitude'],
-                        "waypoint_lon": waypoint['Longitude'],
-                        "waypoint_time": waypoint['Time'],
-                        "site_id": "N/A",
-                        "site_name": "N/A",
-                        "site_lat": dest_lat,
-                        "site_lon": dest_lon,
-                        "destination": f"{mode.capitalize()} to destination",
-                        "direction": "N/A",
-                        "state": "N/A",
-                        "scheduled": "N/A",
-                        "expected": (datetime.strptime(waypoint['Time'], "%Y-%m-%d %H:%M:%S") + eta).strftime(
-                            "%Y-%m-%d %H:%M:%S") if eta != "N/A" else "N/A",
-                        "line_id": "N/A",
-                        "line_designation": mode.capitalize(),
-                        "transport_mode": mode
-                    })
+class Route:
+    """Optimized route in normalized, columnar form.
+
+    waypoints: waypoint_lat/lon/time, indexed by waypoint_id.
+    sites: site_name/lat/lon, indexed by SL site_id.
+    destinations: dest_lat/lon, indexed by destination_id.
+    departures: one row per departure (site_id set) or travel ETA to a
+        destination (destination_id set), referencing the tables above.
+    """
+
+    def __init__(self, waypoints, sites, destinations, departures):
+        self.waypoints = waypoints
+        self.sites = sites
+        self.destinations = destinations
+        self.departures = departures
+
+    def __len__(self):
+        return len(self.departures)
+
+    # Persist the four tables as <prefix>_waypoints, _sites, _destinations and _departures.
+    def save(self, prefix='route'):
+        storage.save_table(self.waypoints.rename_axis('waypoint_id').reset_index(), f'{prefix}_waypoints')
+        storage.save_table(self.sites.reset_index(), f'{prefix}_sites')
+        storage.save_table(self.destinations.rename_axis('destination_id').reset_index(), f'{prefix}_destinations')
+        storage.save_table(self.departures, f'{prefix}_departures')
+
+    @classmethod
+    def load(cls, prefix='route'):
+        return cls(waypoints=storage.load_table(f'{prefix}_waypoints').set_index('waypoint_id'),
+                   sites=storage.load_table(f'{prefix}_sites').set_index('site_id'),
+                   destinations=storage.load_table(f'{prefix}_destinations').set_index('destination_id'),
+                   departures=storage.load_table(f'{prefix}_departures'))
+
+    # Flat table with one row per departure, in the ROUTE_COLUMNS layout.
+    def to_frame(self):
+        dep = self.departures
+        waypoints = self.waypoints.reindex(dep['waypoint_id'].to_numpy())
+        sites = self.sites.reindex(dep['site_id'].to_numpy())
+        destinations = self.destinations.reindex(dep['destination_id'].to_numpy())
+        site_lat = sites['site_lat'].to_numpy(dtype=float)
+        site_lon = sites['site_lon'].to_numpy(dtype=float)
+        frame = pd.DataFrame({
+            'waypoint_lat': waypoints['waypoint_lat'].to_numpy(),
+            'waypoint_lon': waypoints['waypoint_lon'].to_numpy(),
+            'waypoint_time': waypoints['waypoint_time'].to_numpy(),
+            'site_id': dep['site_id'].to_numpy(),
+            'site_name': pd.Categorical(sites['site_name'].to_numpy()),
+            'site_lat': np.where(np.isnan(site_lat), destinations['dest_lat'].to_numpy(), site_lat),
+            'site_lon': np.where(np.isnan(site_lon), destinations['dest_lon'].to_numpy(), site_lon),
+        })
+        for column in ROUTE_COLUMNS[7:]:
+            frame[column] = dep[column].reset_index(drop=True)
+        frame['site_id'] = frame['site_id'].astype('Int64')
+        return frame
+
+
+# Departures of every fetched site as one typed table, sorted by site.
+def _departures_table(departures_by_site):
+    records = [(site_id, dep['destination'], dep['direction'], dep['state'], dep['scheduled'], dep['expected'],
+                dep['line']['id'], dep['line']['designation'], dep['line']['transport_mode'])
+               for site_id, departures in departures_by_site.items() for dep in departures or []]
+    table = pd.DataFrame.from_records(records, columns=['site_id'] + ROUTE_COLUMNS[7:])
+    table['site_id'] = table['site_id'].astype('int64')
+    table['scheduled'] = pd.to_datetime(table['scheduled'], format='ISO8601', errors='coerce')
+    table['expected'] = pd.to_datetime(table['expected'], format='ISO8601', errors='coerce')
+    table['line_id'] = pd.to_numeric(table['line_id'], errors='coerce').astype('Int64')
+    return table.sort_values('site_id', kind='stable', ignore_index=True)
+
+
+# (waypoint, destination) pairs that get ETA rows, ordered by waypoint: every destination,
+# or with destination_users only the destinations of the waypoint's own user.
+def _eta_pairs(waypoint_ids, n_destinations, waypoint_users=None, destination_users=None):
+    if destination_users is None:
+        w, d = np.meshgrid(waypoint_ids, np.arange(n_destinations), indexing='ij')
+        return w.ravel(), d.ravel()
+    pairs = pd.DataFrame({'waypoint_id': waypoint_ids, 'user_id': waypoint_users[waypoint_ids]}).merge(
+        pd.DataFrame({'destination_id': np.arange(n_destinations), 'user_id': np.asarray(destination_users)}),
+        on='user_id')
+    pairs = pairs.sort_values(['waypoint_id', 'destination_id'], kind='stable')
+    return pairs['waypoint_id'].to_numpy(), pairs['destination_id'].to_numpy()
+
+
+# Walk/bike/car ETA rows for (waypoint, destination) pairs, one row per pair and mode.
+def _eta_table(pair_waypoint, pair_destination, coords, times, destination_coords):
+    dest = np.asarray(destination_coords, dtype=float).reshape(-1, 2)
+    modes = list(TRAVEL_SPEEDS_KMH)
+    w = np.repeat(pair_waypoint, len(modes))
+    d = np.repeat(pair_destination, len(modes))
+    m = np.tile(np.arange(len(modes)), len(pair_waypoint))
+    distance_km = haversine_np(coords[w, 0], coords[w, 1], dest[d, 0], dest[d, 1])
+    speed_kmh = np.array([TRAVEL_SPEEDS_KMH[mode] for mode in modes], dtype=float)[m]
+    return pd.DataFrame({
+        'waypoint_id': w,
+        'destination_id': d,
+        'destination': np.array([f"{mode.capitalize()} to destination" for mode in modes], dtype=object)[m],
+        'expected': times[w] + pd.to_timedelta(distance_km / speed_kmh, unit='h').to_numpy(),
+        'line_designation': np.array([mode.capitalize() for mode in modes], dtype=object)[m],
+        'transport_mode': np.array(modes, dtype=object)[m],
+    })
+
+
+# Waypoints of a trajectory as arrays: (n, 2) lat/lon, datetime64[ns] times and index labels.
+def waypoint_arrays(gdf, step=1):
+    waypoints = gdf.iloc[::step]
+    coords = waypoints[['Latitude', 'Longitude']].to_numpy(dtype=float)
+    times = pd.to_datetime(waypoints['Time']).to_numpy(dtype='datetime64[ns]')
+    return coords, times, waypoints.index.to_numpy()
+
+
+# Find the n closest sites within radius for every waypoint in one query.
+@metrics.timed()
+def find_nearby_sites_many(coords, sites_data, radius=1000, n=3):
+    return si.as_index(sites_data).nearest_many(coords, k=n, radius=radius)
+
+
+# Optimize route. Waypoints without nearby sites get ETAs to every destination, or, with
+# destination_users (the user_id of each destination), to their own user's destinations.
+@metrics.timed()
+def optimize_route(gdf, sites_data, destination_coords, step=WAYPOINT_STEP, destination_users=None):
+    sites_index = si.as_index(sites_data)
+    site_ids = sites_index.sites['id'].to_numpy()
+
+    coords, times, labels = waypoint_arrays(gdf, step)
+    valid = ~np.isnan(coords).any(axis=1)
+    for label in labels[~valid]:
+        logging.warning(f"Skipping waypoint with NaN coordinates at index {label}")
+    coords = coords[valid]
+    times = times[valid]
+    waypoint_users = gdf['user_id'].to_numpy()[::step][valid] if destination_users is not None else None
+    waypoint_ids = np.arange(len(coords))
+
+    closest, _ = find_nearby_sites_many(coords, sites_index)
+    used = np.unique(closest[closest >= 0])
+    departures_by_site = fetch_departures_many(site_ids[used].tolist())
+    site_departures = _departures_table(departures_by_site)
+
+    # (waypoint, site) pairs in distance order, expanded to one row per departure of the site.
+    pair_waypoint, pair_rank = np.nonzero(closest >= 0)
+    pair_site = site_ids[closest[pair_waypoint, pair_rank]]
+    block_sites, block_start, block_len = np.unique(site_departures['site_id'].to_numpy(), return_index=True,
+                                                    return_counts=True)
+    # Sites without departures (none fetched, or every fetch failed) have no block.
+    has_block = np.isin(pair_site, block_sites)
+    pair_waypoint = pair_waypoint[has_block]
+    block = np.searchsorted(block_sites, pair_site[has_block])
+    counts = block_len[block]
+    rows = np.repeat(block_start[block] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    departures = site_departures.iloc[rows].reset_index(drop=True)
+    departures.insert(0, 'waypoint_id', np.repeat(pair_waypoint, counts))
+    departures['destination_id'] = pd.array([pd.NA] * len(departures), dtype='Int64')
+
+    # Handle case with no nearby sites
+    no_sites = waypoint_ids[(closest < 0).all(axis=1)]
+    logging.info(f"{len(coords) - len(no_sites)} waypoints near sites, {len(no_sites)} without nearby sites")
+    metrics.inc('waypoints_queried_total', len(coords))
+    metrics.inc('waypoints_without_sites_total', len(no_sites))
+    pair_waypoint, pair_destination = _eta_pairs(no_sites, len(destination_coords), waypoint_users,
+                                                 destination_users)
+    etas = _eta_table(pair_waypoint, pair_destination, coords, times, destination_coords)
+
+    departures = pd.concat([departures, etas], ignore_index=True)
+    departures = departures.sort_values('waypoint_id', kind='stable', ignore_index=True)
+    for column in ['site_id', 'destination_id', 'line_id']:
+        departures[column] = departures[column].astype('Int64')
+    for column in ['scheduled', 'expected']:
+        departures[column] = departures[column].astype('datetime64[ns]')
+    for column in ROUTE_CATEGORIES:
+        departures[column] = departures[column].astype('category')
+
+    sites = sites_index.sites.iloc[used][['id', 'name', 'lat', 'lon']]
+    destinations = pd.DataFrame(np.asarray(destination_coords, dtype=float).reshape(-1, 2),
+                                columns=['dest_lat', 'dest_lon'])
+    if destination_users is not None:
+        destinations['user_id'] = np.asarray(destination_users)
+    route = Route(
+        waypoints=pd.DataFrame({'waypoint_lat': coords[:, 0], 'waypoint_lon': coords[:, 1],
+                                'waypoint_time': times}),
+        sites=sites.set_axis(['site_id', 'site_name', 'site_lat', 'site_lon'], axis=1).set_index('site_id'),
+        destinations=destinations,
+        departures=departures[['waypoint_id', 'site_id', 'destination_id'] + ROUTE_COLUMNS[7:]],
+    )
     logging.info(f"Route generated with {len(route)} entries.")
+    metrics.inc('route_rows_total', len(route))
     return route
 
 
 def lbrp():
     logging.info("Loading user trajectory data")
-    gdf = pd.read_pickle('gdf.pkl')
-    dest = pd.read_pickle('dest.pkl')
+    gdf = storage.load_table('all_user_data', columns=['Latitude', 'Longitude', 'Time', 'user_id'])
+    dest = storage.load_table('destinations', columns=['user_id', 'Latitude', 'Longitude'])
 
-    logging.info("Extracting destination coordinates from dest.pkl")
-    destination_coords = [(row['Latitude'], row['Longitude']) for _, row in dest.iterrows() if row['is_destination']]
+    logging.info("Extracting destination coordinates")
+    destination_coords = list(zip(dest['Latitude'], dest['Longitude']))
 
-    logging.info(f"Destination coordinates: {destination_coords}")
+    logging.info(f"Destination coordinates: {len(destination_coords)}")
+    payload_log.debug("Destination coordinates: %s", destination_coords)
 
     logging.info("Loading sites data")
-    sites_data = load_sites_data()
+    sites_data = load_sites_index(load_sites_data())
 
     logging.info("Optimizing route")
-    optimized_route = optimize_route(gdf, sites_data, destination_coords)
-
-    logging.info(f"Optimized route: {optimized_route}")
-
-    logging.info("Pickling optimized route")
-    with open('optimized_route.pkl', 'wb') as f:
-        pickle.dump(optimized_route, f)
-
-    logging.info("Displaying optimized route")
-    for entry in optimized_route:
-        print(f"Waypoint (Lat: {entry['waypoint_lat']}, Lon: {entry['waypoint_lon']}, Time: {entry['waypoint_time']})")
-        print(
-            f"Site (ID: {entry['site_id']}, Name: {entry['site_name']}, Lat: {entry['site_lat']}, Lon: {entry['site_lon']})")
-        print("Departures:")
-        print(entry['destination'], entry['direction'], entry['state'], entry['scheduled'], entry['expected'])
-        print("\n")
+    route = optimize_route(gdf, sites_data, destination_coords, step=WAYPOINT_STEP,
+                           destination_users=dest['user_id'].to_numpy())
+    logging.info(f"Departure cache: {sl.departure_cache.stats()}")
+
+    logging.info("Saving optimized route")
+    route.save()
+    # Flat view for the readers of optimized_route (user_patterns, trajectory_map, app).
+    optimized_route = route.to_frame()
+    del route
+    payload_log.debug("Optimized route: %s", optimized_route)
+    storage.save_table(optimized_route, 'optimized_route')
+
+    # One line per route entry, only when payload logging is enabled.
+    if payload_log.isEnabledFor(logging.DEBUG):
+        for entry in optimized_route.itertuples(index=False):
+            payload_log.debug(
+                "Waypoint (Lat: %s, Lon: %s, Time: %s) Site (ID: %s, Name: %s, Lat: %s, Lon: %s) Departure: %s %s %s %s %s",
+                entry.waypoint_lat, entry.waypoint_lon, entry.waypoint_time, entry.site_id, entry.site_name,
+                entry.site_lat, entry.site_lon, entry.destination, entry.direction, entry.state, entry.scheduled,
+                entry.expected)
 
 
 
@@ -0,0 +1,191 @@
+import os
+import io
+import json
+import time
+import bisect
+import logging
+import cProfile
+import pstats
+import functools
+import threading
+import contextlib
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""Instrumentation for the pipeline.
+    A process-wide registry of counters and histograms (timers are histograms of
+    seconds), exported as JSON or Prometheus text. Stages can be run under
+    cProfile (LBRP_PROFILE=1). Raw payloads (departures, DataFrames) go to the
+    'lbrp.payloads' logger, which is silent unless LOG_PAYLOADS=1."""
+
+METRICS_FILE = os.getenv('METRICS_FILE', 'metrics.json')
+PROMETHEUS_FILE = os.getenv('PROMETHEUS_FILE', 'metrics.prom')
+PROFILE_ENABLED = os.getenv('LBRP_PROFILE', '0') == '1'
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PREFIX = 'lbrp_'
+
+# Histogram upper bounds in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+payload_log = logging.getLogger('lbrp.payloads')
+payload_log.setLevel(logging.DEBUG if os.getenv('LOG_PAYLOADS', '0') == '1' else logging.WARNING)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    # Cumulative counts per upper bound, as in the Prometheus exposition format.
+    def cumulative(self):
+        total, out = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    # Time a block into the histogram name (seconds).
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Decorator: time every call into function_seconds{function=...}.
+    def timed(self, name=None):
+        def decorator(func):
+            label = name or f'{func.__module__}.{func.__qualname__}'
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer('function_seconds', function=label):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+                           'min': h.min, 'max': h.max,
+                           'buckets': [[None if bound == float('inf') else bound, total]
+                                       for bound, total in h.cumulative()]}
+                          for (name, labels), h in sorted(self.histograms.items())]
+        return {'created': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (h.cumulative(), h.sum, h.count)) for key, h in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            metric = PREFIX + name
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} counter')
+                typed.add(metric)
+            lines.append(f'{metric}{_labels(labels)} {value}')
+        for (name, labels), (cumulative, total, count) in histograms:
+            metric = PREFIX + name
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} histogram')
+                typed.add(metric)
+            for bound, bucket_count in cumulative:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{metric}_bucket{_labels(labels + (("le", le),))} {bucket_count}')
+            lines.append(f'{metric}_sum{_labels(labels)} {total}')
+            lines.append(f'{metric}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics as JSON and/or Prometheus text.
+    def save(self, json_path=METRICS_FILE, prometheus_path=PROMETHEUS_FILE):
+        if json_path:
+            with open(json_path, 'w') as f:
+                f.write(self.to_json())
+        if prometheus_path:
+            with open(prometheus_path, 'w') as f:
+                f.write(self.to_prometheus())
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (k + '="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
+
+
+# Run a block under cProfile when profiling is enabled, writing <name>.prof (for
+# snakeviz/pstats) and <name>.txt (top functions by cumulative time) to PROFILE_DIR.
+@contextlib.contextmanager
+def profile(name, enabled=None):
+    if not (PROFILE_ENABLED if enabled is None else enabled):
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f'{name}.prof'))
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(30)
+        with open(os.path.join(PROFILE_DIR, f'{name}.txt'), 'w') as f:
+            f.write(summary.getvalue())
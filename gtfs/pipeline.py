@@ -0,0 +1,157 @@
+import os
+import glob
+import fnmatch
+import json
+import time
+import logging
+
+import user_trajectories as ut
+import lbrp as lbrp
+import user_patterns as up
+import sl_rtd as sl
+import trajectory_map as tm
+import heatmap as hm
+import metrics
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""Runs the data generation stages in dependency order, skipping a stage when its inputs
+    are unchanged since its last run and its outputs are still on disk."""
+
+PIPELINE_STATE_FILE = 'pipeline_state.json'
+GPX_FILES = os.path.join(os.path.dirname(__file__), 'user_profiles', '*.gpx')
+
+
+class Stage:
+    # inputs/outputs are file paths or glob patterns; max_age (seconds) forces a
+    # rerun of stages that read live data.
+    def __init__(self, name, func, inputs=(), outputs=(), max_age=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.max_age = max_age
+
+
+# Stages in dependency order: a stage runs after every stage producing one of its
+# inputs. Stages without a dependency between them keep their declared order.
+def order_stages(stages):
+    def produces(stage, pattern):
+        return any(fnmatch.fnmatch(output, pattern) for output in stage.outputs)
+
+    depends = {stage.name: {other.name for other in stages if other is not stage
+                            and any(produces(other, pattern) for pattern in stage.inputs)}
+               for stage in stages}
+    ordered, done, remaining = [], set(), list(stages)
+    while remaining:
+        ready = next((stage for stage in remaining if depends[stage.name] <= done), None)
+        if ready is None:
+            raise ValueError(f"Cyclic stage dependencies among {[stage.name for stage in remaining]}")
+        ordered.append(ready)
+        done.add(ready.name)
+        remaining.remove(ready)
+    return ordered
+
+
+STAGES = [
+    Stage('rtd', sl.rtd,
+          outputs=['sites_data.pkl', 'deviations.pkl'],
+          max_age=float(os.getenv('RTD_MAX_AGE', 15 * 60))),
+    Stage('user_trajectory', ut.user_trajectory,
+          inputs=[GPX_FILES],
+          outputs=['all_user_data.parquet', 'destinations.parquet', 'regenerated_48_hour_data.parquet',
+                   'trajectory_store']),
+    Stage('lbrp', lbrp.lbrp,
+          inputs=['all_user_data.parquet', 'destinations.parquet', 'sites_data.pkl'],
+          outputs=['optimized_route.parquet', 'route_waypoints.parquet', 'route_sites.parquet',
+                   'route_destinations.parquet', 'route_departures.parquet']),
+    Stage('user_patterns', up.user_patterns,
+          inputs=['all_user_data.parquet', 'optimized_route.parquet'],
+          outputs=['generalized_optimized_timetable.parquet']),
+    Stage('heatmap', hm.heatmap,
+          inputs=['all_user_data.parquet'],
+          outputs=['heatmap_cells.parquet']),
+    Stage('trajectory_map', tm.create_trajectory_map,
+          inputs=['regenerated_48_hour_data.parquet', 'all_user_data.parquet', 'optimized_route.parquet',
+                  'generalized_optimized_timetable.parquet'],
+          outputs=['simulated_trajectory_map.html']),
+]
+
+
+# Files matched by a pattern; directories (partitioned tables) expand to their files.
+def _expand(pattern):
+    for path in glob.glob(pattern):
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in files:
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+# (path, size, mtime) of every file matched by the patterns.
+def fingerprint(patterns):
+    files = sorted(path for pattern in patterns for path in _expand(pattern))
+    return [[path, os.path.getsize(path), os.path.getmtime(path)] for path in files]
+
+
+def load_state(path=PIPELINE_STATE_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state, path=PIPELINE_STATE_FILE):
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+# Reason the stage has to run, or None if it is up to date.
+def stale_reason(stage, state):
+    previous = state.get(stage.name)
+    if previous is None:
+        return "never run"
+    missing = [path for path in stage.outputs if not os.path.exists(path)]
+    if missing:
+        return f"missing outputs {missing}"
+    if fingerprint(stage.inputs) != previous['inputs']:
+        return "inputs changed"
+    if stage.max_age is not None and time.time() - previous['finished_at'] > stage.max_age:
+        return "outputs expired"
+    return None
+
+
+# Run stale stages in dependency order, timing each one; if any stage ran, the metrics are
+# written to metrics.json / metrics.prom at the end. Returns the names of the stages that ran.
+def run_pipeline(stages=STAGES, force=False, state_path=PIPELINE_STATE_FILE):
+    state = load_state(state_path)
+    ran = []
+    for stage in order_stages(stages):
+        reason = "forced" if force else stale_reason(stage, state)
+        if reason is None:
+            logging.info(f"Stage {stage.name}: up to date, skipping")
+            metrics.inc('stage_skips_total', stage=stage.name)
+            continue
+        logging.info(f"Stage {stage.name}: running ({reason})")
+        inputs = fingerprint(stage.inputs)
+        start = time.perf_counter()
+        with metrics.timer('stage_seconds', stage=stage.name), metrics.profile(stage.name):
+            stage.func()
+        logging.info(f"Stage {stage.name}: finished in {time.perf_counter() - start:.2f} s")
+        metrics.inc('stage_runs_total', stage=stage.name)
+        state[stage.name] = {'inputs': inputs, 'finished_at': time.time()}
+        save_state(state, state_path)
+        ran.append(stage.name)
+    # A run that skipped every stage keeps the metrics of the last run that did work.
+    if ran:
+        metrics.registry.save()
+    return ran
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run_pipeline()
@@ -1,98 +1,213 @@
-import gpxpy
-import gpxpy.gpx
-import random
-from datetime import datetime, timedelta
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 # __Author__: pablo-chacon
-# __Version__: 1.0.0
+# __Version__: 1.1.0
 # __Date__: 2024-05-11
 
+"""Synthetic user trajectories.
+    Each user has a home, a workplace and a few leisure places (drawn from pools
+    shared by all users). Weekdays are home -> work -> (leisure) -> home, weekends
+    are an optional trip from home. A day's visits become keyframes (arrival and
+    departure at each place, legs timed by distance and a mode-dependent speed),
+    and the samples are interpolated between keyframes in one NumPy call.
+    Every user has its own seed, so output does not depend on the number of workers.
+
+    python regen_trajectories.py --users 1000 --days 30 --interval 60 --format parquet --output fleet.parquet"""
+
 # Params
 num_users = 10
 start_lat, start_lon = 59.3293, 18.0686  # Stockholm coordinates
 radius = 0.05  # Random offset.
-workday_locations = ["Workplace", "Park", "Cafe", "Gym"]  # Possible locations for workdays
-weekend_locations = ["Sture P", "Parents", "IKEA", "Countryside", "Gym"]  # Possible locations for weekends
-
-
-def gen_rand_location(center_lat, center_lon, radius):
-    # Random location within radius.
-    lat_offset = random.uniform(-radius, radius)
-    lon_offset = random.uniform(-radius, radius)
-    return center_lat + lat_offset, center_lon + lon_offset
-
-
-def generate_user_profile(start_time, end_time):
-    # Generate user profile.
-    user_gpx = gpxpy.gpx.GPX()
-
-    # Initialize track, segment
-    track = gpxpy.gpx.GPXTrack()
-    segment = gpxpy.gpx.GPXTrackSegment()
-    track.segments.append(segment)
-    user_gpx.tracks.append(track)
-
-    # Random locations
-    locations = {
-        "workdays": random.sample(workday_locations, 4),  # 4 workday locations
-        "weekends": random.sample(weekend_locations, 4)  # 4 weekend locations
+START_TIME = '2024-03-01'
+PARQUET_FILE = 'user_profiles.parquet'
+N_WORKPLACES = 40
+N_LEISURE_PLACES = 60
+LEISURE_PER_USER = 4
+METERS_PER_DEGREE = 111320.0
+
+# Travel speed (km/h) by leg distance: walk below 1.5 km, bike below 5 km, transit beyond.
+MODE_MAX_KM = np.array([1.5, 5.0, np.inf])
+MODE_SPEED_KMH = np.array([5.0, 15.0, 25.0])
+
+
+# Workplace and leisure pools shared by all users of a seed.
+def make_places(seed=42, center=(start_lat, start_lon), spread=radius):
+    rng = np.random.default_rng([seed, 0])
+    return {
+        'work': np.asarray(center) + rng.uniform(-spread, spread, (N_WORKPLACES, 2)),
+        'leisure': np.asarray(center) + rng.uniform(-spread, spread, (N_LEISURE_PLACES, 2)),
     }
 
-    # User movements
-    current_time = start_time
-    while current_time <= end_time:
-        # Return to starting point once every 24 hours
-        if current_time.hour == 0 and current_time.minute == 0:
-            lat, lon = start_lat, start_lon
-        else:
-            lat, lon = gen_rand_location(start_lat, start_lon, radius)
-
-        # Random location 6-9 hours mon-fri
-        if current_time.weekday() < 5:
-            stay_time = random.randint(6, 9)
-            location = random.choice(locations["workdays"])
-        # Rec time 1-2 hours on workdays.
-        elif current_time.weekday() < 7:
-            stay_time = random.randint(1, 2)
-            location = random.choice(locations["workdays"])
-        # Weekend stuff.
-        else:
-            stay_time = random.randint(2, 10)
-            location = random.choice(locations["weekends"])
 
-        # Create GPX track point
-        point = gpxpy.gpx.GPXTrackPoint(
-            latitude=lat,
-            longitude=lon,
-            elevation=0,  # Elevation can be adjusted if needed
-            time=current_time
-        )
-        user_gpx.tracks[0].segments[0].points.append(point)
-
-        # Update time for next point
-        current_time += timedelta(hours=stay_time)
-
-    return user_gpx
-
-
-# Generate random locations
-random.seed(42)  # Ensure reproducibility
-workday_locations = [gen_rand_location(start_lat, start_lon, radius) for _ in range(len(workday_locations))]
-weekend_locations = [gen_rand_location(start_lat, start_lon, radius) for _ in range(len(weekend_locations))]
-
-# Generate profiles
-user_profiles = []
-for i in range(num_users):
-    start_time = datetime(2024, 3, 1, 8, 0, 0)  # Start time
-    end_time = start_time + timedelta(days=30)  # End time (30 days simulation)
-    user_gpx = generate_user_profile(start_time, end_time)
-    user_profiles.append(user_gpx)
-
-
-# Write GPX user files
-for i, user_gpx in enumerate(user_profiles):
-    with open(f"user_{i + 1}_profile.gpx", "w") as gpx_file:
-        gpx_file.write(user_gpx.to_xml())
-
-print("User profiles generated successfully.")
+def _travel_seconds(rng, a, b):
+    dlat = (b[..., 0] - a[..., 0]) * METERS_PER_DEGREE
+    dlon = (b[..., 1] - a[..., 1]) * METERS_PER_DEGREE * np.cos(np.radians(a[..., 0]))
+    km = np.hypot(dlat, dlon) / 1000
+    speed = MODE_SPEED_KMH[np.searchsorted(MODE_MAX_KM, km)] * rng.uniform(0.8, 1.2, km.shape)
+    return km / speed * 3600 + 120
+
+
+# Keyframes (seconds since start, lat, lon) for one user over n_days.
+# Each day has up to 6 keyframes: leave home, arrive/leave work or trip place,
+# arrive/leave leisure, arrive home; unused slots are dropped.
+def user_keyframes(rng, places, n_days, start=START_TIME):
+    home = np.array([start_lat, start_lon]) + rng.uniform(-radius, radius, 2)
+    work = places['work'][rng.integers(len(places['work']))]
+    leisure = places['leisure'][rng.choice(len(places['leisure']), LEISURE_PER_USER, replace=False)]
+
+    day = np.arange(n_days)
+    weekday = (pd.Timestamp(start).dayofweek + day) % 7 < 5
+    hour = 3600.0
+
+    # Weekdays go to work; weekends to a leisure place, if they go out at all.
+    first = np.where(weekday[:, None], work, leisure[rng.integers(LEISURE_PER_USER, size=n_days)])
+    goes_out = weekday | (rng.random(n_days) < 0.7)
+    extra = weekday & (rng.random(n_days) < 0.4)
+    second = leisure[rng.integers(LEISURE_PER_USER, size=n_days)]
+
+    leave_home = day * 24 * hour + np.where(weekday, np.clip(rng.normal(8, 0.75, n_days), 6, 10),
+                                            rng.uniform(10, 14, n_days)) * hour
+    arrive_first = leave_home + _travel_seconds(rng, home, first)
+    leave_first = arrive_first + np.where(weekday, rng.uniform(6, 9, n_days), rng.uniform(2, 5, n_days)) * hour
+    arrive_second = leave_first + _travel_seconds(rng, first, second)
+    leave_second = arrive_second + rng.uniform(1, 2, n_days) * hour
+    last = np.where(extra[:, None], second, first)
+    arrive_home = np.where(extra, leave_second, leave_first) + _travel_seconds(rng, last, home)
+
+    times = np.stack([leave_home, arrive_first, leave_first, arrive_second, leave_second, arrive_home], axis=1)
+    points = np.stack([np.broadcast_to(home, first.shape), first, first, second, second,
+                       np.broadcast_to(home, first.shape)], axis=1)
+    used = np.stack([goes_out, goes_out, goes_out, extra, extra, goes_out], axis=1)
+    times, points = times[used], points[used]
+    # A long day can run past the next morning's departure; keep the keyframes ordered.
+    return np.maximum.accumulate(times), points[:, 0], points[:, 1], home
+
+
+# One user's samples every interval_s seconds over days, as (Latitude, Longitude, Time).
+# jitter_m adds GPS noise (meters, standard deviation).
+def generate_user(rng, places, days, interval_s=600, start=START_TIME, jitter_m=5.0):
+    n_days = int(np.ceil(days))
+    times, lat, lon, home = user_keyframes(rng, places, n_days, start)
+    t = np.arange(0, days * 86400, interval_s, dtype=float)
+    if len(times):
+        sample_lat = np.interp(t, times, lat, left=home[0], right=home[0])
+        sample_lon = np.interp(t, times, lon, left=home[1], right=home[1])
+    else:
+        sample_lat, sample_lon = np.full(len(t), home[0]), np.full(len(t), home[1])
+    if jitter_m:
+        noise = rng.normal(0, jitter_m / METERS_PER_DEGREE, (2, len(t)))
+        sample_lat = sample_lat + noise[0]
+        sample_lon = sample_lon + noise[1] / np.cos(np.radians(sample_lat))
+    times = (pd.Timestamp(start) + pd.to_timedelta(t, unit='s')).astype('datetime64[ns]')
+    return pd.DataFrame({'Latitude': sample_lat, 'Longitude': sample_lon, 'Time': times})
+
+
+def user_filename(index):
+    return f"user_{index + 1}_profile.gpx"
+
+
+def write_gpx(path, df):
+    stamps = df['Time'].dt.strftime('%Y-%m-%dT%H:%M:%S')
+    points = '\n'.join(f'      <trkpt lat="{a:.6f}" lon="{b:.6f}"><time>{t}</time></trkpt>'
+                       for a, b, t in zip(df['Latitude'].tolist(), df['Longitude'].tolist(), stamps))
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="regen_trajectories">\n'
+                f'  <trk>\n    <trkseg>\n{points}\n    </trkseg>\n  </trk>\n</gpx>\n')
+
+
+# Users [first, last) with their own seeds. GPX chunks are written by the worker and
+# return only the point count; other formats return the chunk's rows.
+def _generate_chunk(first, last, days, interval_s, seed, start, jitter_m, fmt, output):
+    places = make_places(seed)
+    frames, total = [], 0
+    for index in range(first, last):
+        rng = np.random.default_rng([seed, 1, index])
+        df = generate_user(rng, places, days, interval_s, start, jitter_m)
+        total += len(df)
+        if fmt == 'gpx':
+            write_gpx(os.path.join(output, user_filename(index)), df)
+        else:
+            df['user_id'] = user_filename(index)
+            frames.append(df)
+    if fmt == 'gpx':
+        return total, None
+    return total, pd.concat(frames, ignore_index=True) if frames else None
+
+
+# Generate n_users trajectories into output: a folder of GPX files (fmt='gpx') or one
+# flat Parquet file of raw points (fmt='parquet'; user_id, Latitude, Longitude and Time
+# in ns, the columns parse_gpx yields, not the derived all_user_data table). An output
+# folder gets PARQUET_FILE inside it. Users are produced in
+# chunks of chunk_users on workers processes, and at most 2 * workers chunks are held
+# in memory at once. Returns the number of points written.
+def generate(n_users=num_users, days=30, interval_s=600, seed=42, output='.', fmt='gpx', workers=1,
+             chunk_users=100, start=START_TIME, jitter_m=5.0):
+    if fmt not in ('gpx', 'parquet'):
+        raise ValueError(f"Unknown format {fmt!r}, expected 'gpx' or 'parquet'")
+    if fmt == 'gpx':
+        os.makedirs(output, exist_ok=True)
+    elif os.path.isdir(output):
+        output = os.path.join(output, PARQUET_FILE)
+    chunks = [(first, min(first + chunk_users, n_users), days, interval_s, seed, start, jitter_m, fmt, output)
+              for first in range(0, n_users, chunk_users)]
+
+    writer, total = None, 0
+    try:
+        for count, frame in _ordered_map(_generate_chunk, chunks, workers):
+            total += count
+            if frame is not None:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                writer = writer or pq.ParquetWriter(output, table.schema)
+                writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return total
+
+
+# map() in submission order with a bounded number of chunks in flight.
+def _ordered_map(func, args_list, workers):
+    if workers <= 1:
+        for args in args_list:
+            yield func(*args)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for args in args_list:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic user trajectories.")
+    parser.add_argument('--users', type=int, default=num_users)
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--interval', type=float, default=600, help="seconds between points")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--start', default=START_TIME)
+    parser.add_argument('--jitter', type=float, default=5.0, help="GPS noise in meters")
+    parser.add_argument('--format', choices=['gpx', 'parquet'], default='gpx')
+    parser.add_argument('--output', default='.',
+                        help=f"folder for gpx; file, or folder to write {PARQUET_FILE} in, for parquet")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-users', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    total = generate(args.users, args.days, args.interval, args.seed, args.output, args.format, args.workers,
+                     args.chunk_users, args.start, args.jitter)
+    print(f"User profiles generated successfully: {args.users} users, {total} points.")
+
+
+if __name__ == '__main__':
+    main()
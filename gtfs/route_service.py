@@ -0,0 +1,292 @@
+import os
+import json
+import math
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import sl_rtd as sl
+import storage
+import metrics
+import trajectory_store
+from lbrp import TRAVEL_SPEEDS_KMH
+from user_trajectories import haversine_np
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""Resident route query service.
+    Loads the stop index and the users' destinations once and answers, per
+    request, the nearby stops with their upcoming departures and the ETA to the
+    user's destinations. Departures come from the
+    shared departure cache; a request waits at most ROUTE_DEADLINE_MS for
+    departures that are not cached, the rest are marked pending and keep loading
+    into the cache in the background.
+
+    python route_service.py --port 8080
+    GET /route?user=user_1_profile.gpx&lat=59.33&lon=18.06&time=2024-06-01T08:00:00
+    GET /health, GET /metrics (Prometheus text)"""
+
+ROUTE_SERVICE_HOST = os.getenv('ROUTE_SERVICE_HOST', '127.0.0.1')
+ROUTE_SERVICE_PORT = int(os.getenv('ROUTE_SERVICE_PORT', 8080))
+ROUTE_DEADLINE_MS = float(os.getenv('ROUTE_DEADLINE_MS', 50))
+ROUTE_TIME_WINDOW = int(os.getenv('ROUTE_TIME_WINDOW', 30))
+RELOAD_INTERVAL = float(os.getenv('ROUTE_RELOAD_INTERVAL', 30))
+# How far ahead (minutes) a query's time may be; the SL forecast window is limited.
+MAX_AHEAD_MINUTES = int(os.getenv('ROUTE_MAX_AHEAD_MINUTES', 120))
+QUERY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+def _mtime(path):
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+# The stop index with its columns as plain lists, so a query does not touch pandas.
+# Replaced as a whole on reload, so a query never mixes two versions.
+class SiteSnapshot:
+    def __init__(self, index):
+        self.index = index
+        self.ids = index.sites['id'].astype(int).tolist() if len(index) else []
+        self.names = index.sites['name'].tolist()
+        self.coords = index.sites[['lat', 'lon']].to_numpy(dtype=float).tolist()
+
+    def __len__(self):
+        return len(self.index)
+
+
+class RouteService:
+    def __init__(self, deadline_ms=ROUTE_DEADLINE_MS, time_window=ROUTE_TIME_WINDOW, workers=None):
+        self.deadline_ms = deadline_ms
+        self.time_window = time_window
+        self.executor = ThreadPoolExecutor(max_workers=workers or 2 * sl.max_concurrency)
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._versions = {}
+        self.sites = None
+        self.destinations = {}
+        self.store = None
+        self.reload()
+
+    # Load whatever changed on disk since the last load.
+    def reload(self):
+        versions = {'sites': _mtime('sites_data.pkl'),
+                    'destinations': _mtime(storage.table_path('destinations')),
+                    'store': _mtime(os.path.join(trajectory_store.TRAJECTORY_STORE_DIR, 'offsets.npy'))}
+        if versions['sites'] != self._versions.get('sites') or self.sites is None:
+            self.sites = SiteSnapshot(sl.load_sites_index(sl.load_sites_data()))
+        if versions['destinations'] != self._versions.get('destinations'):
+            self.destinations = self._load_destinations()
+        if versions['store'] != self._versions.get('store'):
+            self.store = trajectory_store.TrajectoryStore() if versions['store'] is not None else None
+        self._versions = versions
+        self._checked_at = time.monotonic()
+
+    def maybe_reload(self):
+        if time.monotonic() - self._checked_at < RELOAD_INTERVAL:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked_at >= RELOAD_INTERVAL:
+                self.reload()
+
+    # {user_id: (n, 2) array of distinct destination lat/lon}.
+    @staticmethod
+    def _load_destinations():
+        if not storage.table_exists('destinations'):
+            return {}
+        dest = storage.load_table('destinations', columns=['user_id', 'Latitude', 'Longitude'])
+        dest = dest.round({'Latitude': 5, 'Longitude': 5}).drop_duplicates()
+        return {user_id: group[['Latitude', 'Longitude']].to_numpy(dtype=float)
+                for user_id, group in dest.groupby('user_id', sort=False)}
+
+    # Last recorded position of a user, used when a request has no lat/lon.
+    def last_position(self, user_id):
+        if self.store is None:
+            return None
+        points = self.store.get_user(user_id)
+        if len(points['Latitude']) == 0:
+            return None
+        return float(points['Latitude'][-1]), float(points['Longitude'][-1])
+
+    # Forecast window (minutes from now) covering time_window minutes after `at`. Rounded up
+    # to a multiple of time_window so queries for nearby times share cache entries.
+    def _forecast_window(self, at, now):
+        ahead = (at - now).total_seconds() / 60
+        if ahead < -1 or ahead > MAX_AHEAD_MINUTES:
+            raise ValueError(f"time must be between now and {MAX_AHEAD_MINUTES} minutes ahead")
+        return self.time_window * (1 + math.ceil(max(ahead, 0) / self.time_window))
+
+    # Departures per site within the deadline: {site_id: departures or None if still pending}.
+    # Cached sites are answered directly; the others are fetched on the executor.
+    def _departures(self, site_ids, window=None):
+        window = window or self.time_window
+        result, futures = {}, {}
+        for site_id in site_ids:
+            departures = sl.cached_departures(site_id, window)
+            if departures is not None:
+                result[site_id] = departures
+            else:
+                futures[site_id] = self.executor.submit(sl.fetch_departures, site_id, window)
+        if futures:
+            wait(futures.values(), timeout=self.deadline_ms / 1000)
+        for site_id, future in futures.items():
+            if not future.done():
+                metrics.inc('route_departures_pending_total')
+                result[site_id] = None
+            elif future.exception() is not None:
+                result[site_id] = []
+            else:
+                result[site_id] = future.result()
+        return result
+
+    def query(self, user_id=None, lat=None, lon=None, at=None, k=3, radius=1000):
+        self.maybe_reload()
+        if lat is None or lon is None:
+            position = self.last_position(user_id) if user_id is not None else None
+            if position is None:
+                raise ValueError("lat and lon are required for users without a recorded position")
+            lat, lon = position
+        now = datetime.now()
+        at = at or now
+        window = self._forecast_window(at, now)
+        walk_mps = TRAVEL_SPEEDS_KMH['walk'] / 3.6
+
+        sites = self.sites
+        ind, dist = sites.index.nearest_many([[lat, lon]], k=k, radius=radius)
+        nearby = [(pos, distance) for pos, distance in zip(ind[0].tolist(), dist[0].tolist()) if pos >= 0]
+        departures = self._departures([sites.ids[pos] for pos, _ in nearby], window)
+
+        stops = []
+        for pos, distance in nearby:
+            site_id = sites.ids[pos]
+            walk = timedelta(seconds=distance / walk_mps)
+            site_departures = departures[site_id]
+            stops.append({
+                'site_id': site_id, 'name': sites.names[pos], 'lat': sites.coords[pos][0],
+                'lon': sites.coords[pos][1], 'distance_m': round(distance, 1), 'walk_s': round(walk.total_seconds()),
+                'pending': site_departures is None,
+                'departures': [_departure(d, at + walk) for d in site_departures or []
+                               if not _leaves_before(d, at)],
+            })
+
+        destinations = []
+        dest = self.destinations.get(user_id)
+        if dest is not None and len(dest):
+            distance_km = haversine_np(lat, lon, dest[:, 0], dest[:, 1])
+            for (dest_lat, dest_lon), km in zip(dest.tolist(), distance_km.tolist()):
+                destinations.append({
+                    'lat': dest_lat, 'lon': dest_lon, 'distance_km': round(km, 3),
+                    'eta': {mode: (at + timedelta(hours=km / speed)).isoformat(timespec='seconds')
+                            for mode, speed in TRAVEL_SPEEDS_KMH.items()},
+                })
+
+        return {'user_id': user_id, 'lat': lat, 'lon': lon, 'time': at.isoformat(timespec='seconds'),
+                'stops': stops, 'destinations': destinations}
+
+
+# Expected (else scheduled) departure time, or None if missing or unparsable.
+def _departure_time(departure):
+    try:
+        return datetime.fromisoformat(departure.get('expected') or departure.get('scheduled'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _leaves_before(departure, at):
+    leaves = _departure_time(departure)
+    return leaves is not None and leaves < at
+
+
+# One departure as returned to clients; catchable if it leaves after the user can reach the stop.
+def _departure(departure, ready_at):
+    line = departure.get('line') or {}
+    leaves = _departure_time(departure)
+    catchable = leaves >= ready_at if leaves is not None else None
+    return {'line_id': line.get('id'), 'line': line.get('designation'), 'transport_mode': line.get('transport_mode'),
+            'destination': departure.get('destination'), 'direction': departure.get('direction'),
+            'scheduled': departure.get('scheduled'), 'expected': departure.get('expected'), 'catchable': catchable}
+
+
+def _float(params, name, default=None):
+    value = params.get(name, [None])[0]
+    return default if value in (None, '') else float(value)
+
+
+class RouteRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/route':
+            self._route(parse_qs(url.query))
+        elif url.path == '/health':
+            self._send(200, {'status': 'ok', 'sites': len(self.service.sites),
+                             'users': len(self.service.destinations),
+                             'departure_cache': sl.departure_cache.stats()})
+        elif url.path == '/metrics':
+            self._send(200, metrics.registry.to_prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self._send(404, {'error': f'unknown path {url.path}'})
+
+    def _route(self, params):
+        start = time.perf_counter()
+        try:
+            at = params.get('time', [None])[0]
+            body = self.service.query(
+                user_id=params.get('user', [None])[0], lat=_float(params, 'lat'), lon=_float(params, 'lon'),
+                at=datetime.fromisoformat(at) if at else None, k=int(_float(params, 'k', 3)),
+                radius=_float(params, 'radius', 1000))
+            status = 200
+        except ValueError as e:
+            body, status = {'error': str(e)}, 400
+        except Exception as e:
+            logging.exception("Route query failed")
+            body, status = {'error': f'{type(e).__name__}: {e}'}, 500
+        took = time.perf_counter() - start
+        metrics.observe('route_query_seconds', took, buckets=QUERY_BUCKETS)
+        metrics.inc('route_queries_total', status=status)
+        if status == 200:
+            body['took_ms'] = round(took * 1000, 2)
+        self._send(status, body)
+
+    def _send(self, status, body, content_type='application/json'):
+        data = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def make_server(host=ROUTE_SERVICE_HOST, port=ROUTE_SERVICE_PORT, service=None):
+    handler = type('Handler', (RouteRequestHandler,), {'service': service or RouteService()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve route queries over HTTP.")
+    parser.add_argument('--host', default=ROUTE_SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=ROUTE_SERVICE_PORT)
+    args = parser.parse_args(argv)
+    # force: importing lbrp already configured the root logger at DEBUG.
+    logging.basicConfig(level=logging.INFO, force=True)
+    server = make_server(args.host, args.port)
+    logging.info(f"Route service listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
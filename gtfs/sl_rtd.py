@@ -1,8 +1,19 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+import threading
+import time
+import hashlib
+import json
 import pandas as pd
-from geopy.distance import geodesic
 from dotenv import load_dotenv
 import os
+import stop_index as si
+import sl_transport
+import metrics
+from metrics import payload_log
 
 # __Author__: pablo-chacon
 # __Version__: 1.0.3
@@ -11,18 +22,118 @@ import os
 # Load .env vars.
 load_dotenv()
 
-# Real-Time Data URLs.
-deviations_url = 'https://deviations.integration.sl.se/v1/messages?'
-departures_url_template = 'https://transport.integration.sl.se/v1/sites/{site_id}/departures'
-sites_url = 'https://transport.integration.sl.se/v1/sites'
+# Real-Time Data URLs, overridable to point at a local stub server.
+deviations_base_url = os.getenv('SL_DEVIATIONS_URL', 'https://deviations.integration.sl.se/v1')
+transport_base_url = os.getenv('SL_TRANSPORT_URL', 'https://transport.integration.sl.se/v1')
+deviations_url = f'{deviations_base_url}/messages?'
+departures_url_template = f'{transport_base_url}/sites/{{site_id}}/departures'
+sites_url = f'{transport_base_url}/sites'
 
+# HTTP client settings.
+request_timeout = float(os.getenv('SL_REQUEST_TIMEOUT', 10))
+request_retries = int(os.getenv('SL_REQUEST_RETRIES', 3))
+max_concurrency = int(os.getenv('SL_MAX_CONCURRENCY', 8))
 
-def make_request(url, params=None):
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    response = requests.get(url, headers=headers, params=params)
-    print(f"Request URL: {response.url}")
+# Sites catalogue refresh settings.
+sites_max_age = float(os.getenv('SL_SITES_MAX_AGE', 24 * 3600))
+sites_meta_file = 'sites_data.meta.json'
+
+# Departure cache settings.
+departures_ttl = float(os.getenv('SL_DEPARTURES_TTL', 30))
+departures_cache_size = int(os.getenv('SL_DEPARTURES_CACHE_SIZE', 4096))
+
+# Transport: 'http' (live API), 'record' (live API, responses appended to SL_ARCHIVE)
+# or 'replay' (SL_ARCHIVE served offline with simulated latency and errors).
+transport_mode = os.getenv('SL_TRANSPORT', 'http')
+archive_file = os.getenv('SL_ARCHIVE', sl_transport.SL_ARCHIVE_FILE)
+replay_latency_ms = os.getenv('SL_REPLAY_LATENCY_MS', '0')
+replay_latency_sigma = float(os.getenv('SL_REPLAY_LATENCY_SIGMA', 0.5))
+replay_error_rate = float(os.getenv('SL_REPLAY_ERROR_RATE', 0))
+replay_timeout_rate = float(os.getenv('SL_REPLAY_TIMEOUT_RATE', 0))
+
+_session = None
+_session_lock = threading.Lock()
+_transport = None
+
+
+# Shared session: keeps connections alive and retries transient failures.
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=request_retries, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset(['GET']), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Content-Type': 'application/json'})
+            _session = session
+    return _session
+
+
+def _make_transport(mode=None):
+    mode = mode or transport_mode
+    if mode == 'http':
+        return sl_transport.HTTPTransport(get_session)
+    if mode == 'record':
+        return sl_transport.RecordingTransport(sl_transport.HTTPTransport(get_session), archive_file)
+    if mode == 'replay':
+        latency = replay_latency_ms if replay_latency_ms == 'recorded' else float(replay_latency_ms)
+        return sl_transport.ReplayTransport(archive_file, latency_ms=latency, latency_sigma=replay_latency_sigma,
+                                            error_rate=replay_error_rate, timeout_rate=replay_timeout_rate)
+    raise ValueError(f"Unknown SL_TRANSPORT {mode!r}, expected 'http', 'record' or 'replay'")
+
+
+def get_transport():
+    global _transport
+    with _session_lock:
+        if _transport is None:
+            _transport = _make_transport()
+    return _transport
+
+
+# Replace the transport (e.g. with a ReplayTransport in load tests). Returns the previous one.
+def set_transport(transport):
+    global _transport
+    with _session_lock:
+        previous, _transport = _transport, transport
+    return previous
+
+
+# Endpoint label for request metrics.
+def _endpoint(url):
+    if url.startswith(deviations_base_url):
+        return 'deviations'
+    if url.rstrip('/').endswith('/departures'):
+        return 'departures'
+    if url.rstrip('/') == sites_url:
+        return 'sites'
+    return 'other'
+
+
+# GET through the transport, counting the call and timing it by endpoint.
+def _get(url, params=None, headers=None, timeout=None):
+    endpoint = _endpoint(url)
+    start = time.perf_counter()
+    try:
+        response = get_transport().get(url, params=params, headers=headers, timeout=timeout)
+    except requests.RequestException:
+        metrics.inc('http_requests_total', endpoint=endpoint, status='error')
+        raise
+    finally:
+        metrics.observe('http_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+    metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+    payload_log.debug("Request URL: %s", response.url)
+    return response
+
+
+def make_request(url, params=None, timeout=None):
+    try:
+        response = _get(url, params=params, timeout=timeout or request_timeout)
+    except requests.RequestException as e:
+        print(f"Failed to fetch data from {url}: {e}")
+        return None
     if response.status_code == 200:
         return response.json()
     else:
@@ -30,14 +141,73 @@ def make_request(url, params=None):
         return None
 
 
-def fetch_and_save_sites_data():
-    sites_data = make_request(sites_url)
-    if sites_data:
-        sites_df = pd.json_normalize(sites_data)
+# GET with HTTP validators. Returns the response, or None on connection errors.
+def make_conditional_request(url, etag=None, last_modified=None, timeout=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        response = _get(url, headers=headers, timeout=timeout or request_timeout)
+    except requests.RequestException as e:
+        print(f"Failed to fetch data from {url}: {e}")
+        return None
+    return response
+
+
+def load_sites_meta():
+    try:
+        with open(sites_meta_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_sites_meta(meta):
+    with open(sites_meta_file, 'w') as f:
+        json.dump(meta, f)
+
+
+# Refresh sites_data.pkl. Skips the download while the stored copy is younger than
+# max_age, sends If-None-Match/If-Modified-Since otherwise, and only rewrites the
+# catalogue and its spatial index when the content changed. Returns True if rewritten.
+def fetch_and_save_sites_data(max_age=None, force=False):
+    max_age = sites_max_age if max_age is None else max_age
+    meta = load_sites_meta() if os.path.exists('sites_data.pkl') and not force else {}
+    if meta and time.time() - meta.get('fetched_at', 0) < max_age:
+        print("Sites data is fresh, skipping download.")
+        return False
+
+    response = make_conditional_request(sites_url, meta.get('etag'), meta.get('last_modified'))
+    if response is None:
+        print("Failed to fetch sites data.")
+        return False
+    if response.status_code == 304:
+        meta['fetched_at'] = time.time()
+        save_sites_meta(meta)
+        print("Sites data not modified.")
+        return False
+    if response.status_code != 200:
+        print(f"Failed to fetch sites data, Status Code: {response.status_code}, Message: {response.text}")
+        return False
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    changed = digest != meta.get('sha256')
+    if changed:
+        sites_df = pd.json_normalize(response.json())
         sites_df.to_pickle('sites_data.pkl')
+        si.build_sites_index(sites_df)
         print("Sites data saved successfully.")
     else:
-        print("Failed to fetch sites data.")
+        print("Sites data unchanged.")
+    save_sites_meta({
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'sha256': digest,
+        'fetched_at': time.time(),
+    })
+    return changed
 
 
 def save_deviations():
@@ -59,23 +229,99 @@ def load_sites_data():
         return pd.DataFrame()
 
 
+# Load the spatial index over the sites data.
+def load_sites_index(sites_df=None):
+    try:
+        return si.load_sites_index(sites_df)
+    except Exception as e:
+        print(f"Failed to load sites index: {e}")
+        return si.StopIndex(sites_df if sites_df is not None else pd.DataFrame(columns=si.SITE_COLUMNS))
+
+
 def find_nearby_sites(sites_df, user_lat, user_lon, max_distance_km=1.0):
-    nearby_sites = []
-    user_location = (user_lat, user_lon)
+    index = si.as_index(sites_df)
+    nearby = index.within(user_lat, user_lon, radius=max_distance_km * 1000).drop(columns='distance')
+    return [site for _, site in nearby.iterrows()]
+
+
+# TTL + LRU cache. Concurrent lookups of a missing key share one fetch.
+class DepartureCache:
+    def __init__(self, ttl=30, maxsize=4096):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._pending = {}  # key -> Future of the in-flight fetch
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # Fresh cached value, or None (does not fetch).
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        metrics.inc('departure_cache_total', result='hit')
+        return entry[1]
+
+    def get_or_fetch(self, key, fetch):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc('departure_cache_total', result='hit')
+                return entry[1]
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.coalesced += 1
+                metrics.inc('departure_cache_total', result='coalesced')
+            else:
+                self.misses += 1
+                metrics.inc('departure_cache_total', result='miss')
+                self._pending[key] = Future()
+        if pending is not None:
+            return pending.result()
+
+        try:
+            value = fetch()
+        except BaseException as e:
+            with self._lock:
+                future = self._pending.pop(key)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            future = self._pending.pop(key)
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "size": len(self._entries)}
 
-    # Filter out rows with missing or NaN coordinates
-    sites_df = sites_df.dropna(subset=['lat', 'lon'])
 
-    for _, site in sites_df.iterrows():
-        site_location = (site['lat'], site['lon'])
-        distance = geodesic(user_location, site_location).km
-        if distance <= max_distance_km:
-            nearby_sites.append(site)
+departure_cache = DepartureCache(ttl=departures_ttl, maxsize=departures_cache_size)
 
-    return nearby_sites
 
+# Raised when the departures request failed (connection error, timeout or non-200),
+# so the failure is not cached as a site without departures.
+class DeparturesUnavailable(Exception):
+    pass
 
-def fetch_departures(site_id, time_window=15, transport_mode=None, direction=None, line=None):
+
+def _fetch_departures(site_id, time_window=15, transport_mode=None, direction=None, line=None):
     url = departures_url_template.format(site_id=site_id)
     params = {"forecast": time_window}
     if transport_mode:
@@ -85,38 +331,79 @@ def fetch_departures(site_id, time_window=15, transport_mode=None, direction=Non
     if line:
         params["line"] = line
     departures_data = make_request(url, params=params)
-    if departures_data:
-        print(f"Departures Data for site ID {site_id}: {departures_data}")
-        return departures_data.get('departures', [])
-    return []
+    if departures_data is None:
+        raise DeparturesUnavailable(f"No departures response for site ID {site_id}")
+    payload_log.debug("Departures data for site ID %s: %s", site_id, departures_data)
+    return departures_data.get('departures', []) if departures_data else []
+
+
+def _departures_key(site_id, time_window=15, transport_mode=None, direction=None, line=None):
+    return str(site_id), time_window, transport_mode, direction, line
+
+
+def fetch_departures(site_id, time_window=15, transport_mode=None, direction=None, line=None, use_cache=True):
+    if not use_cache:
+        return _fetch_departures(site_id, time_window, transport_mode, direction, line)
+    key = _departures_key(site_id, time_window, transport_mode, direction, line)
+    return departure_cache.get_or_fetch(
+        key, lambda: _fetch_departures(site_id, time_window, transport_mode, direction, line))
+
+
+# Cached departures for a site, or None if they are not cached (never fetches).
+def cached_departures(site_id, time_window=15, transport_mode=None, direction=None, line=None):
+    return departure_cache.get(_departures_key(site_id, time_window, transport_mode, direction, line))
+
+
+# Fetch departures for many sites concurrently. Returns {site_id: departures}; a site
+# whose fetch fails gets [] without affecting the others.
+def fetch_departures_many(site_ids, time_window=15, transport_mode=None, direction=None, line=None,
+                          max_workers=None):
+    site_ids = list(dict.fromkeys(site_ids))
+    if not site_ids:
+        return {}
+
+    def fetch(site_id):
+        try:
+            return fetch_departures(site_id, time_window, transport_mode, direction, line)
+        except Exception as e:
+            print(f"Failed to fetch departures for site ID {site_id}: {e}")
+            return []
+
+    workers = min(max_workers or max_concurrency, len(site_ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(site_ids, executor.map(fetch, site_ids)))
 
 
 def test_known_site():
     known_site_id = '1002'
-    departures_data = fetch_departures(known_site_id, time_window=120, transport_mode="BUS")
+    try:
+        departures_data = fetch_departures(known_site_id, time_window=120, transport_mode="BUS")
+    except Exception as e:
+        print(f"Failed to fetch departures for site ID {known_site_id}: {e}")
+        return
     if departures_data:
-        print(f"Departures for known site ID {known_site_id}: {departures_data}")
+        payload_log.debug("Departures for known site ID %s: %s", known_site_id, departures_data)
 
 
 def rtd():
     fetch_and_save_sites_data()
     sites_df = load_sites_data()
+    sites_index = load_sites_index(sites_df)
     print(sites_df.head())
     deviations_df = save_deviations()
     user_lat, user_lon = 59.328284, 18.016154
     print(f"Latitude: {user_lat}, Longitude: {user_lon}")
-    nearby_sites = find_nearby_sites(sites_df, user_lat, user_lon, max_distance_km=1.0)
-    print(f"Nearby Sites: {nearby_sites}")
+    nearby_sites = find_nearby_sites(sites_index, user_lat, user_lon, max_distance_km=1.0)
+    print(f"Nearby Sites: {len(nearby_sites)}")
+    payload_log.debug("Nearby sites: %s", nearby_sites)
 
+    site_ids = [site['id'] for site in nearby_sites if site['id']]
+    departures_by_site = fetch_departures_many(site_ids, time_window=120, transport_mode="BUS")
     all_departures = []
-    for site in nearby_sites:
-        site_id = site['id']
-        print(f"Processing site ID: {site_id}")
-        if site_id:
-            departures_data = fetch_departures(site_id, time_window=120, transport_mode="BUS")
-            if departures_data:
-                all_departures.append({"site_id": site_id, "departures": departures_data})
-                print(f"Departures for site ID {site_id}: {departures_data}")
+    for site_id, departures_data in departures_by_site.items():
+        if departures_data:
+            all_departures.append({"site_id": site_id, "departures": departures_data})
+            payload_log.debug("Departures for site ID %s: %s", site_id, departures_data)
 
     test_known_site()
 
@@ -0,0 +1,180 @@
+import os
+import re
+import gzip
+import json
+import time
+import atexit
+import hashlib
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit, urlencode
+import numpy as np
+import requests
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""Transports for the SL API calls in sl_rtd.
+    HTTPTransport talks to the live endpoints. RecordingTransport wraps another
+    transport and appends every response to an archive; ReplayTransport serves
+    an archive offline with simulated latency, error responses and timeouts.
+
+    The archive is one gzip JSON-lines file. Each response body is stored once
+    (keyed by its sha256), so repeated identical departures cost one line."""
+
+SL_ARCHIVE_FILE = 'sl_archive.jsonl.gz'
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+# Minimal stand-in for requests.Response for replayed responses.
+class ArchivedResponse:
+    def __init__(self, status_code, content, headers=None, url=''):
+        self.status_code = status_code
+        self.content = content
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+# Archive key: the URL path (base URL stripped, so an archive replays against any
+# host) plus the sorted query parameters.
+def request_key(url, params=None):
+    parts = urlsplit(url)
+    query = dict(pair.split('=', 1) for pair in parts.query.split('&') if '=' in pair)
+    query.update({k: str(v) for k, v in (params or {}).items() if v is not None})
+    path = re.sub(r'^.*?/v\d+(?=/)', '', parts.path).rstrip('/')
+    return path + ('?' + urlencode(sorted(query.items())) if query else '')
+
+
+# Endpoint family of a key (numeric path segments replaced), used as a fallback
+# when replaying requests that were never recorded, e.g. departures of another site.
+def endpoint_key(key):
+    return re.sub(r'/\d+(?=/|$)', '/{id}', key.split('?', 1)[0])
+
+
+class HTTPTransport:
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        return self.session_factory().get(url, params=params, headers=headers, timeout=timeout)
+
+
+# Hashes of the bodies already stored in an archive, so that appending to it
+# does not store them again.
+def _archived_bodies(path):
+    if not os.path.exists(path):
+        return set()
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        records = (json.loads(line) for line in f)
+        return {record['sha256'] for record in records if 'sha256' in record}
+
+
+class RecordingTransport:
+    def __init__(self, inner, path=SL_ARCHIVE_FILE):
+        self.inner = inner
+        self.path = path
+        self._bodies = _archived_bodies(path)
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        start = time.perf_counter()
+        response = self.inner.get(url, params=params, headers=headers, timeout=timeout)
+        elapsed = time.perf_counter() - start
+        body = hashlib.sha256(response.content).hexdigest()
+        entry = {'key': request_key(url, params), 'status': response.status_code, 'elapsed': round(elapsed, 4),
+                 'headers': {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers},
+                 'body': body, 'recorded_at': time.time()}
+        with self._lock:
+            if body not in self._bodies:
+                self._bodies.add(body)
+                self._file.write(json.dumps({'sha256': body, 'data': response.content.decode('utf-8')}) + '\n')
+            self._file.write(json.dumps(entry) + '\n')
+        return response
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class ReplayTransport:
+    # latency_ms: median simulated latency, drawn from a lognormal with sigma
+    # latency_sigma; 'recorded' replays the latency measured while recording.
+    # error_rate: share of requests answered with 503; timeout_rate: share that
+    # raise requests.Timeout. fallback serves a recorded response of the same
+    # endpoint family for requests that were not recorded (otherwise 404).
+    def __init__(self, path=SL_ARCHIVE_FILE, latency_ms=0.0, latency_sigma=0.5, error_rate=0.0, timeout_rate=0.0,
+                 fallback=True, seed=None, sleep=time.sleep):
+        self.responses = defaultdict(list)  # key -> [entry]
+        self.families = defaultdict(list)  # endpoint family -> [entry]
+        self.bodies = {}
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if 'sha256' in record:
+                    self.bodies[record['sha256']] = record['data'].encode('utf-8')
+                else:
+                    self.responses[record['key']].append(record)
+                    self.families[endpoint_key(record['key'])].append(record)
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.fallback = fallback
+        self.sleep = sleep
+        self._rng = np.random.default_rng(seed)
+        self._next = defaultdict(int)  # key -> position of the next response to serve
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.responses.values())
+
+    # Recorded responses of a key are served in rotation.
+    def _entry(self, key):
+        entries = self.responses.get(key)
+        if not entries and self.fallback:
+            entries = self.families.get(endpoint_key(key))
+            key = endpoint_key(key)
+        if not entries:
+            return None
+        with self._lock:
+            position = self._next[key]
+            self._next[key] = position + 1
+        return entries[position % len(entries)]
+
+    def _latency(self, entry):
+        if self.latency_ms == 'recorded':
+            return entry['elapsed'] if entry else 0.0
+        if not self.latency_ms:
+            return 0.0
+        with self._lock:
+            return float(self._rng.lognormal(np.log(self.latency_ms / 1000), self.latency_sigma))
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        key = request_key(url, params)
+        entry = self._entry(key)
+        with self._lock:
+            draw = self._rng.random()
+        delay = self._latency(entry)
+        if draw < self.timeout_rate:
+            self.sleep(timeout or delay)
+            raise requests.Timeout(f"Simulated timeout for {key}")
+        self.sleep(delay)
+        if draw < self.timeout_rate + self.error_rate:
+            return ArchivedResponse(503, b'Service Unavailable (simulated)', url=url)
+        if entry is None:
+            return ArchivedResponse(404, b'Not recorded', url=url)
+        etag = entry['headers'].get('ETag')
+        if etag and headers and headers.get('If-None-Match') == etag:
+            return ArchivedResponse(304, b'', entry['headers'], url=url)
+        return ArchivedResponse(entry['status'], self.bodies[entry['body']], entry['headers'], url=url)
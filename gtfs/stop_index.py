@@ -0,0 +1,97 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-01
+
+"""Spatial index over the SL sites catalogue.
+    Answers radius and k-nearest stop queries without scanning every site."""
+
+EARTH_RADIUS_M = 6371008.8
+SITES_INDEX_FILE = 'sites_index.pkl'
+SITE_COLUMNS = ['id', 'name', 'lat', 'lon']
+
+
+class StopIndex:
+    # Build a haversine BallTree over the sites with valid coordinates. An empty
+    # catalogue (or one without coordinates) gives an empty index without a tree.
+    def __init__(self, sites_df):
+        missing = [column for column in SITE_COLUMNS if column not in sites_df.columns]
+        sites_df = sites_df.assign(**{column: np.nan for column in missing})
+        self.sites = sites_df.dropna(subset=['lat', 'lon']).reset_index(drop=True)
+        self.coords = np.radians(self.sites[['lat', 'lon']].to_numpy(dtype=float))
+        self.tree = BallTree(self.coords, metric='haversine') if len(self.coords) else None
+
+    def __len__(self):
+        return len(self.sites)
+
+    # Rows of the sites table plus a 'distance' column in meters, closest first.
+    def _rows(self, ind, dist):
+        order = np.argsort(dist, kind='stable')
+        rows = self.sites.iloc[ind[order]].copy()
+        rows['distance'] = dist[order]
+        return rows
+
+    # All sites within radius (meters) of a point.
+    def within(self, lat, lon, radius=1000):
+        if self.tree is None:
+            return self._rows(np.array([], dtype=int), np.array([]))
+        point = np.radians([[lat, lon]])
+        ind, dist = self.tree.query_radius(point, r=radius / EARTH_RADIUS_M, return_distance=True)
+        return self._rows(ind[0], dist[0] * EARTH_RADIUS_M)
+
+    # The k closest sites to a point, optionally limited to radius (meters).
+    def nearest(self, lat, lon, k=3, radius=None):
+        ind, dist = self.nearest_many([[lat, lon]], k=k, radius=radius)
+        found = ind[0] >= 0
+        return self._rows(ind[0][found], dist[0][found])
+
+    # Batch k-nearest query for an (n, 2) array of lat/lon.
+    # Returns (n, k) site positions and distances in meters, closest first;
+    # slots with no site within radius hold -1 and inf.
+    def nearest_many(self, coords, k=3, radius=None):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        k = min(k, len(self))
+        if len(coords) == 0 or k == 0:
+            return np.full((len(coords), k), -1, dtype=int), np.full((len(coords), k), np.inf)
+        dist, ind = self.tree.query(np.radians(coords), k=k)
+        dist = dist * EARTH_RADIUS_M
+        if radius is not None:
+            outside = dist > radius
+            ind = np.where(outside, -1, ind)
+            dist = np.where(outside, np.inf, dist)
+        return ind, dist
+
+
+# Build the index and persist it next to sites_data.pkl.
+def build_sites_index(sites_df, path=SITES_INDEX_FILE):
+    index = StopIndex(sites_df)
+    with open(path, 'wb') as f:
+        pickle.dump(index, f)
+    return index
+
+
+# Load the persisted index, rebuilding it if it is missing or older than the sites data.
+def load_sites_index(sites_df=None, path=SITES_INDEX_FILE, sites_path='sites_data.pkl'):
+    fresh = os.path.exists(path) and (
+        not os.path.exists(sites_path) or os.path.getmtime(path) >= os.path.getmtime(sites_path))
+    if fresh:
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"Failed to load sites index: {e}")
+    if sites_df is None:
+        sites_df = pd.read_pickle(sites_path)
+    return build_sites_index(sites_df, path)
+
+
+# Use an existing index as-is, or index a plain sites DataFrame.
+def as_index(sites):
+    if isinstance(sites, StopIndex):
+        return sites
+    return StopIndex(sites)
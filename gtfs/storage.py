@@ -0,0 +1,138 @@
+import os
+import shutil
+import threading
+import time
+import pandas as pd
+import geopandas as gpd
+import metrics
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""Columnar (Parquet) storage for the artefacts handed between stages.
+    Tables are written as <name>.parquet in the working directory, optionally
+    partitioned into a hive-style dataset, and read back with column projection
+    and predicate pushdown."""
+
+# Tables partitioned on disk, and the columns they are partitioned by.
+PARTITIONS = {
+    'all_user_data': ['user_id', 'date'],
+    'regenerated_48_hour_data': ['user_id'],
+    'heatmap_cells': ['zoom'],
+}
+
+
+def table_path(name):
+    return f'{name}.parquet'
+
+
+def table_exists(name):
+    return os.path.exists(table_path(name))
+
+
+# Object columns holding mixed types (e.g. ints and "N/A") cannot be stored as one
+# Parquet type; store those as strings.
+def _arrow_safe(df):
+    df = pd.DataFrame(df).copy()
+    if 'geometry' in df.columns:
+        df = df.drop(columns='geometry')
+    for col in df.columns:
+        if df[col].dtype == object:
+            types = {type(v) for v in df[col].dropna()}
+            if len(types) > 1:
+                df[col] = df[col].map(lambda v: v if pd.isna(v) else str(v)).astype('string')
+    return df
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+# Move a freshly written table into place. A file replaces a file atomically; a
+# directory (partitioned table) replaces the old version by two renames, the old one
+# moved aside first, so readers never see a missing or half-written table.
+def _swap_in(tmp, path):
+    if os.path.isdir(path) or (os.path.isdir(tmp) and os.path.exists(path)):
+        old = f'{path}.old-{os.getpid()}-{threading.get_ident()}'
+        os.rename(path, old)
+        os.rename(tmp, path)
+        _remove(old)
+    else:
+        os.replace(tmp, path)
+
+
+# Write a DataFrame (or list of records) as a table, replacing any previous version.
+# The table is written next to the old one and swapped in when complete.
+def save_table(data, name, partition_cols=None):
+    df = _arrow_safe(pd.DataFrame(data) if isinstance(data, list) else data)
+    partition_cols = PARTITIONS.get(name) if partition_cols is None else partition_cols
+    path = table_path(name)
+    tmp = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    _remove(tmp)
+    try:
+        with metrics.timer('table_io_seconds', table=name, op='write'):
+            if partition_cols:
+                if 'date' in partition_cols and 'date' not in df.columns:
+                    df['date'] = df['Time'].dt.strftime('%Y-%m-%d')
+                df.to_parquet(tmp, partition_cols=partition_cols, index=False)
+            else:
+                df.to_parquet(tmp, index=False)
+        _swap_in(tmp, path)
+    except BaseException:
+        _remove(tmp)
+        raise
+    metrics.inc('table_rows_written_total', len(df), table=name)
+    return path
+
+
+# A partitioned table swapped in by save_table while it is being read loses the files the
+# reader listed (or is briefly absent between the two renames); read the new version.
+def _read_parquet(path, attempts=5, **kwargs):
+    for attempt in range(attempts):
+        try:
+            return pd.read_parquet(path, **kwargs)
+        except FileNotFoundError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.01 * (attempt + 1))
+
+
+# Read a table. columns projects, users/start/end filter on user_id and Time and are
+# pushed down to the partitions and row groups; filters takes extra pyarrow filters.
+def load_table(name, columns=None, users=None, start=None, end=None, filters=None, geometry=False):
+    partition_cols = PARTITIONS.get(name) or []
+    predicates = list(filters or [])
+    if users is not None:
+        predicates.append(('user_id', 'in', list(users)))
+    if start is not None:
+        predicates.append(('Time', '>=', pd.Timestamp(start)))
+        if 'date' in partition_cols:
+            predicates.append(('date', '>=', pd.Timestamp(start).strftime('%Y-%m-%d')))
+    if end is not None:
+        predicates.append(('Time', '<=', pd.Timestamp(end)))
+        if 'date' in partition_cols:
+            predicates.append(('date', '<=', pd.Timestamp(end).strftime('%Y-%m-%d')))
+
+    read_columns = columns
+    if columns is not None and geometry:
+        read_columns = list(dict.fromkeys(list(columns) + ['Latitude', 'Longitude']))
+    with metrics.timer('table_io_seconds', table=name, op='read'):
+        df = _read_parquet(table_path(name), columns=read_columns, filters=predicates or None)
+    metrics.inc('table_rows_read_total', len(df), table=name)
+
+    # Partition columns come back as categoricals; restore plain values.
+    for col in partition_cols:
+        if col in df.columns:
+            df[col] = df[col].astype(str)
+    if 'date' in partition_cols and 'date' in df.columns and (columns is None or 'date' not in columns):
+        df = df.drop(columns='date')
+    if 'Time' in df.columns:
+        df = df.sort_values(['user_id', 'Time'] if 'user_id' in df.columns else 'Time',
+                            kind='stable', ignore_index=True)
+    if geometry:
+        df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.Longitude, df.Latitude))
+    return df
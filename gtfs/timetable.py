@@ -0,0 +1,132 @@
+import pickle
+import numpy as np
+import pandas as pd
+import metrics
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""Incremental generalized timetable.
+    Keeps running statistics per (site_id, line_id, destination) and merges new
+    departure observations into them, so the history never has to be rescanned."""
+
+TIMETABLE_STATE_FILE = 'timetable_state.pkl'
+KEYS = ['site_id', 'line_id', 'destination']
+
+# Delay histogram (expected - scheduled, seconds): fixed bins plus an under- and an
+# overflow bin. Histograms of the same layout merge by addition.
+DELAY_BIN_SECONDS = 15
+DELAY_MIN_SECONDS = -10 * 60
+DELAY_MAX_SECONDS = 60 * 60
+N_DELAY_BINS = (DELAY_MAX_SECONDS - DELAY_MIN_SECONDS) // DELAY_BIN_SECONDS + 2
+
+
+def _delay_bins(delay):
+    bins = np.floor((delay - DELAY_MIN_SECONDS) / DELAY_BIN_SECONDS).astype(int) + 1
+    return np.clip(bins, 0, N_DELAY_BINS - 1)
+
+
+# Approximate quantile from a delay histogram (upper edge of the bin reaching q).
+def _histogram_quantile(histogram, q):
+    total = histogram.sum(axis=1)
+    reached = histogram.cumsum(axis=1) >= (q * total)[:, None]
+    bins = reached.argmax(axis=1)
+    edges = DELAY_MIN_SECONDS + np.clip(bins, 1, N_DELAY_BINS - 2) * DELAY_BIN_SECONDS
+    return np.where(total > 0, edges, np.nan)
+
+
+class TimetableAggregator:
+    def __init__(self):
+        # One row per key: count, mean scheduled/expected (epoch seconds), delay mean and
+        # M2 (sum of squared deviations), transport mode and the latest scheduled time seen.
+        self.stats = pd.DataFrame(
+            {'count': pd.Series(dtype='int64'), 'scheduled_mean': pd.Series(dtype='float64'),
+             'expected_mean': pd.Series(dtype='float64'), 'delay_mean': pd.Series(dtype='float64'),
+             'delay_m2': pd.Series(dtype='float64'), 'transport_mode': pd.Series(dtype='object'),
+             'last_scheduled': pd.Series(dtype='datetime64[ns]')},
+            index=pd.MultiIndex.from_arrays([[], [], []], names=KEYS))
+        self.histograms = np.zeros((0, N_DELAY_BINS), dtype='int64')
+
+    def __len__(self):
+        return len(self.stats)
+
+    @classmethod
+    def load(cls, path=TIMETABLE_STATE_FILE):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return cls()
+
+    def save(self, path=TIMETABLE_STATE_FILE):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    # Merge departures (site_id, line_id, destination, scheduled, expected, transport_mode).
+    # Each departure is counted once: repeats within the batch and departures not later
+    # than the last scheduled time already merged for their key are skipped.
+    @metrics.timed()
+    def update(self, departures):
+        obs = pd.DataFrame({
+            'site_id': departures['site_id'], 'line_id': departures['line_id'],
+            'destination': departures['destination'].astype(object),
+            'scheduled': pd.to_datetime(departures['scheduled'], errors='coerce').astype('datetime64[ns]'),
+            'expected': pd.to_datetime(departures['expected'], errors='coerce').astype('datetime64[ns]'),
+            'transport_mode': departures['transport_mode'].astype(object),
+        }).dropna(subset=KEYS + ['scheduled', 'expected'])
+        obs = obs.drop_duplicates(subset=KEYS + ['scheduled'])
+        last = self.stats['last_scheduled'].reindex(pd.MultiIndex.from_frame(obs[KEYS])).to_numpy()
+        obs = obs[pd.isna(last) | (obs['scheduled'].to_numpy() > last)]
+        if obs.empty:
+            return 0
+
+        obs['scheduled_s'] = obs['scheduled'].astype('int64') / 1e9
+        obs['expected_s'] = obs['expected'].astype('int64') / 1e9
+        obs['delay'] = obs['expected_s'] - obs['scheduled_s']
+        grouped = obs.groupby(KEYS, sort=False)
+        obs['delay_dev2'] = (obs['delay'] - grouped['delay'].transform('mean')) ** 2
+        batch = grouped.agg(count=('delay', 'size'), scheduled_mean=('scheduled_s', 'mean'),
+                            expected_mean=('expected_s', 'mean'), delay_mean=('delay', 'mean'),
+                            delay_m2=('delay_dev2', 'sum'), transport_mode=('transport_mode', 'first'),
+                            last_scheduled=('scheduled', 'max'))
+
+        batch_histograms = np.zeros((len(batch), N_DELAY_BINS), dtype='int64')
+        np.add.at(batch_histograms, (grouped.ngroup().to_numpy(), _delay_bins(obs['delay'].to_numpy())), 1)
+
+        # Align the existing state with the batch keys and merge (Chan et al. pairwise update).
+        keys = self.stats.index.union(batch.index, sort=False)
+        old = self.stats.reindex(keys)
+        new = batch.reindex(keys)
+        n_a = old['count'].fillna(0).to_numpy()
+        n_b = new['count'].fillna(0).to_numpy()
+        n = n_a + n_b
+        merged = pd.DataFrame(index=keys)
+        merged['count'] = n.astype('int64')
+        for column in ['scheduled_mean', 'expected_mean', 'delay_mean']:
+            merged[column] = (old[column].fillna(0).to_numpy() * n_a + new[column].fillna(0).to_numpy() * n_b) / n
+        delta = new['delay_mean'].fillna(0).to_numpy() - old['delay_mean'].fillna(0).to_numpy()
+        merged['delay_m2'] = (old['delay_m2'].fillna(0).to_numpy() + new['delay_m2'].fillna(0).to_numpy()
+                              + delta ** 2 * n_a * n_b / n)
+        merged['transport_mode'] = old['transport_mode'].fillna(new['transport_mode'])
+        merged['last_scheduled'] = np.fmax(old['last_scheduled'].to_numpy(), new['last_scheduled'].to_numpy())
+
+        histograms = np.zeros((len(keys), N_DELAY_BINS), dtype='int64')
+        histograms[keys.get_indexer(self.stats.index)] = self.histograms
+        histograms[keys.get_indexer(batch.index)] += batch_histograms
+        self.stats, self.histograms = merged, histograms
+        return len(obs)
+
+    # Generalized timetable: the columns of the batch version plus count and delay statistics.
+    def to_frame(self):
+        stats = self.stats
+        timetable = stats.index.to_frame(index=False)
+        timetable['scheduled'] = pd.to_datetime(stats['scheduled_mean'].to_numpy(), unit='s')
+        timetable['expected'] = pd.to_datetime(stats['expected_mean'].to_numpy(), unit='s')
+        timetable['transport_mode'] = stats['transport_mode'].to_numpy()
+        timetable['count'] = stats['count'].to_numpy()
+        timetable['delay_mean'] = stats['delay_mean'].to_numpy()
+        timetable['delay_std'] = np.sqrt(stats['delay_m2'].to_numpy() / np.maximum(stats['count'].to_numpy(), 1))
+        timetable['delay_p50'] = _histogram_quantile(self.histograms, 0.5)
+        timetable['delay_p90'] = _histogram_quantile(self.histograms, 0.9)
+        return timetable
@@ -1,11 +1,24 @@
+import os
 import folium
-import pandas as pd
+import numpy as np
+from shapely.geometry import LineString
+import storage
+import trajectory_store
 
 
 # __Author__: pablo-chacon
 # __Version__: 1.0.2
 # __Date__: 2024-06-02
 
+# 'vector' writes each dataset as one GeoJSON layer with simplified tracks and
+# deduplicated site markers; 'markers' is the original one-marker-per-row output.
+MAP_RENDER_MODE = os.getenv('MAP_RENDER_MODE', 'vector')
+MAP_SIMPLIFY_M = float(os.getenv('MAP_SIMPLIFY_M', 10))
+MAP_MAX_POINTS = int(os.getenv('MAP_MAX_POINTS', 20000))
+COORD_DECIMALS = 6
+METERS_PER_DEGREE = 111320.0
+
+
 def plot_48_hour_data(m, data):
     for user_id, user_data in data.groupby('user_id'):
         folium.PolyLine(user_data[['Latitude', 'Longitude']].values, color='purple', weight=2.5, opacity=0.8).add_to(m)
@@ -69,26 +82,113 @@ def plot_generalized_timetable(m, data):
         ).add_to(m)
 
 
-def create_trajectory_map():
-    regenerated_48_hour_data = pd.read_pickle('regenerated_48_hour_data.pkl')
-    all_user_data = pd.read_pickle('all_user_data.pkl')
+# Douglas-Peucker simplification of one track, with the tolerance in meters
+# (lon is scaled by cos(lat) so the tolerance is the same in both directions).
+def simplify_track(lat, lon, tolerance_m=MAP_SIMPLIFY_M):
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if len(lat) < 3 or tolerance_m <= 0:
+        return lat, lon
+    scale = np.cos(np.radians(lat.mean()))
+    line = LineString(np.column_stack([lon * scale, lat]) * METERS_PER_DEGREE)
+    xy = np.asarray(line.simplify(tolerance_m, preserve_topology=False).coords) / METERS_PER_DEGREE
+    return xy[:, 1], xy[:, 0] / scale
+
+
+# Every step-th point so that at most max_points are drawn (tracks keep their order).
+def cap_points(data, max_points=MAP_MAX_POINTS):
+    if max_points is None or len(data) <= max_points:
+        return data
+    step = int(np.ceil(len(data) / max_points))
+    print(f"Map: drawing every {step}th of {len(data)} points")
+    return data.iloc[::step]
+
+
+def _coords(lat, lon):
+    return np.round(np.column_stack([lon, lat]), COORD_DECIMALS).tolist()
+
+
+# One GeoJSON layer per dataset: a simplified LineString per user (in time order) and all
+# points as a single MultiPoint drawn with circle markers.
+def plot_track_layer(m, data, name, color, radius, tolerance_m=MAP_SIMPLIFY_M, max_points=MAP_MAX_POINTS):
+    if data.empty:
+        return
+    if 'Time' in data.columns:
+        data = data.sort_values(['user_id', 'Time'], kind='stable')
+    features = []
+    for user_id, user_data in data.groupby('user_id', sort=False):
+        lat, lon = simplify_track(user_data['Latitude'], user_data['Longitude'], tolerance_m)
+        if len(lat) > 1:
+            features.append({'type': 'Feature', 'properties': {'user_id': str(user_id)},
+                             'geometry': {'type': 'LineString', 'coordinates': _coords(lat, lon)}})
+    points = cap_points(data, max_points)
+    features.append({'type': 'Feature', 'properties': {},
+                     'geometry': {'type': 'MultiPoint',
+                                  'coordinates': _coords(points['Latitude'], points['Longitude'])}})
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        name=name,
+        style_function=lambda feature: {'color': color, 'weight': 2.5, 'opacity': 0.8,
+                                        'fillColor': color, 'fillOpacity': 0.6},
+        marker=folium.CircleMarker(radius=radius, color=color, fill=True, fill_color=color, fill_opacity=0.6),
+    ).add_to(m)
+
+
+# One marker per distinct site (listing every line served there) and the site-to-waypoint
+# connectors as a single MultiLineString.
+def plot_sites_layer(m, data, lat_col, lon_col, name_col, label, name, marker_color, line_color, dash_array=None):
+    missing = [col for col in [lat_col, lon_col, 'waypoint_lat', 'waypoint_lon'] if col not in data.columns]
+    if missing:
+        print(f"{name} data does not contain {missing} columns.")
+        return
+    data = data.dropna(subset=[lat_col, lon_col, 'waypoint_lat', 'waypoint_lon'])
+    if data.empty:
+        return
+    layer = folium.FeatureGroup(name=name)
+    for (lat, lon), site in data.groupby([lat_col, lon_col], sort=False):
+        lines = ', '.join(sorted(site['line_id'].dropna().astype(str).unique()))
+        folium.Marker(
+            location=[lat, lon],
+            popup=f"Route: {lines}<br>{label}: {site[name_col].iloc[0]}",
+            icon=folium.Icon(color=marker_color, icon='info-sign')
+        ).add_to(layer)
+    links = data[[lat_col, lon_col, 'waypoint_lat', 'waypoint_lon']].round(COORD_DECIMALS).drop_duplicates()
+    segments = np.stack([links[[lon_col, lat_col]].to_numpy(), links[['waypoint_lon', 'waypoint_lat']].to_numpy()],
+                        axis=1)
+    folium.GeoJson(
+        {'type': 'Feature', 'properties': {},
+         'geometry': {'type': 'MultiLineString', 'coordinates': segments.tolist()}},
+        style_function=lambda feature: {'color': line_color, 'weight': 2, 'opacity': 0.7, 'dashArray': dash_array},
+    ).add_to(layer)
+    layer.add_to(m)
+
+
+# Timetable rows with the coordinates its layer draws: the stop (site_lat_dest/site_lon_dest)
+# and every distinct route waypoint it serves (waypoint_lat/waypoint_lon).
+def timetable_links(timetable, optimized_route):
+    links = optimized_route[['site_id', 'site_lat', 'site_lon', 'waypoint_lat', 'waypoint_lon']]
+    links = links.dropna(subset=['site_id']).drop_duplicates()
+    links = links.rename(columns={'site_lat': 'site_lat_dest', 'site_lon': 'site_lon_dest'})
+    return timetable.merge(links, on='site_id', how='inner')
+
+
+def create_trajectory_map(users=None, start=None, end=None, mode=MAP_RENDER_MODE):
+    point_columns = ['Latitude', 'Longitude', 'Time', 'user_id']
+    regenerated_48_hour_data = storage.load_table('regenerated_48_hour_data', columns=point_columns, users=users)
+    if users is None and start is None and end is None:
+        all_user_data = storage.load_table('all_user_data', columns=point_columns)
+    else:
+        all_user_data = trajectory_store.TrajectoryStore().get_users(users, start, end)
 
     # Load optimized route with error handling
     try:
-        optimized_route_df = pd.read_pickle('optimized_route.pkl')
+        optimized_route_df = storage.load_table('optimized_route')
     except Exception as e:
-        print(f"Error loading optimized_route.pkl: {e}")
+        print(f"Error loading optimized route: {e}")
         return
 
-    if isinstance(optimized_route_df, list):
-        optimized_route_df = pd.DataFrame(optimized_route_df)
-    generalized_optimized_timetable = pd.read_pickle('generalized_optimized_timetable.pkl')
-
-    # Ensure waypoint columns exist in generalized_optimized_timetable.
-    if 'waypoint_lat' not in generalized_optimized_timetable.columns or 'waypoint_lon' not in generalized_optimized_timetable.columns:
-        generalized_optimized_timetable = pd.merge(generalized_optimized_timetable,
-                                                   optimized_route_df[['site_id', 'waypoint_lat', 'waypoint_lon']],
-                                                   on='site_id', how='left')
+    generalized_optimized_timetable = timetable_links(storage.load_table('generalized_optimized_timetable'),
+                                                      optimized_route_df)
 
     # Define map center.
     map_center = [all_user_data['Latitude'].mean(), all_user_data['Longitude'].mean()]
@@ -97,13 +197,19 @@ def create_trajectory_map():
     m = folium.Map(location=map_center, zoom_start=12, tiles='OpenStreetMap')
 
     # Plot data.
-    plot_48_hour_data(m, regenerated_48_hour_data)
-    plot_all_user_data(m, all_user_data)
-    plot_optimized_route(m, optimized_route_df)
-    plot_generalized_timetable(m, generalized_optimized_timetable)
+    if mode == 'markers':
+        plot_48_hour_data(m, regenerated_48_hour_data)
+        plot_all_user_data(m, all_user_data)
+        plot_optimized_route(m, optimized_route_df)
+        plot_generalized_timetable(m, generalized_optimized_timetable)
+    else:
+        plot_track_layer(m, regenerated_48_hour_data, '48-hour movements', 'purple', radius=5)
+        plot_track_layer(m, all_user_data, 'User trajectories', 'blue', radius=3)
+        plot_sites_layer(m, optimized_route_df, 'site_lat', 'site_lon', 'site_name', 'Stop',
+                         'Optimized route stops', 'red', 'red')
+        plot_sites_layer(m, generalized_optimized_timetable, 'site_lat_dest', 'site_lon_dest', 'destination',
+                         'Destination', 'Timetable destinations', 'green', 'orange', dash_array='5,10')
+        folium.LayerControl().add_to(m)
 
     # Save map.
     m.save('simulated_trajectory_map.html')
-
-
-
@@ -0,0 +1,76 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# __Author__: pablo-chacon
+# __Version__: 1.0.0
+# __Date__: 2024-06-02
+
+"""On-disk trajectory store for random access by user and time range.
+    Points are kept sorted by (user_id, Time) in fixed-width lat/lon/time arrays
+    with a per-user offset index; the arrays are memory-mapped, so reading one
+    user or one day touches only those pages."""
+
+TRAJECTORY_STORE_DIR = 'trajectory_store'
+
+
+# Write lat/lon (float64), time (datetime64[ns]) and the per-user offset index.
+def build_trajectory_store(df, path=TRAJECTORY_STORE_DIR):
+    df = df.sort_values(['user_id', 'Time'], kind='stable')
+    users, counts = np.unique(df['user_id'].astype(str).to_numpy(), return_counts=True)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'lat.npy'), df['Latitude'].to_numpy(dtype='float64'))
+    np.save(os.path.join(path, 'lon.npy'), df['Longitude'].to_numpy(dtype='float64'))
+    np.save(os.path.join(path, 'time.npy'), df['Time'].to_numpy(dtype='datetime64[ns]'))
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    with open(os.path.join(path, 'users.json'), 'w') as f:
+        json.dump(users.tolist(), f)
+    return path
+
+
+class TrajectoryStore:
+    def __init__(self, path=TRAJECTORY_STORE_DIR):
+        self.lat = np.load(os.path.join(path, 'lat.npy'), mmap_mode='r')
+        self.lon = np.load(os.path.join(path, 'lon.npy'), mmap_mode='r')
+        self.time = np.load(os.path.join(path, 'time.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        with open(os.path.join(path, 'users.json')) as f:
+            self.users = json.load(f)
+        self._user_pos = {user_id: i for i, user_id in enumerate(self.users)}
+
+    def __len__(self):
+        return len(self.lat)
+
+    # Row range [lo, hi) of a user's points within [start, end] (binary search on time).
+    def _bounds(self, user_id, start=None, end=None):
+        pos = self._user_pos.get(user_id)
+        if pos is None:
+            return 0, 0
+        lo, hi = int(self.offsets[pos]), int(self.offsets[pos + 1])
+        times = self.time[lo:hi]
+        if start is not None:
+            lo += int(np.searchsorted(times, np.datetime64(pd.Timestamp(start), 'ns'), side='left'))
+        if end is not None:
+            hi = int(self.offsets[pos]) + int(np.searchsorted(times, np.datetime64(pd.Timestamp(end), 'ns'),
+                                                              side='right'))
+        return lo, max(lo, hi)
+
+    # Zero-copy views of one user's points, optionally limited to [start, end].
+    def get_user(self, user_id, start=None, end=None):
+        lo, hi = self._bounds(user_id, start, end)
+        return {'Latitude': self.lat[lo:hi], 'Longitude': self.lon[lo:hi], 'Time': self.time[lo:hi]}
+
+    # Points of several users (all by default) as a DataFrame in the all_user_data layout.
+    def get_users(self, users=None, start=None, end=None):
+        frames = []
+        for user_id in (self.users if users is None else users):
+            points = self.get_user(user_id, start, end)
+            frame = pd.DataFrame({column: np.asarray(values) for column, values in points.items()})
+            frame['user_id'] = user_id
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=['Latitude', 'Longitude', 'Time', 'user_id'])
+        return pd.concat(frames, ignore_index=True)
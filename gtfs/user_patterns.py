@@ -1,34 +1,89 @@
+import os
 import pickle
 import pandas as pd
 import numpy as np
+import geopandas as gpd
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans, DBSCAN, HDBSCAN
 from sklearn.preprocessing import StandardScaler
+from sklearn.neighbors import BallTree
 from shapely.geometry import Point
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+import storage
+from user_trajectories import haversine_np
+from stop_index import EARTH_RADIUS_M
+import trajectory_store
+import metrics
+from metrics import payload_log
+from timetable import TimetableAggregator, TIMETABLE_STATE_FILE
 
 
 # __Author__: pablo-chacon
 # __Version__: 1.0.3
 # __Date__: 2024-06-01
 
+# Stop detection: a step shorter than DWELL_RADIUS_M lasting at least DWELL_MIN_SECONDS.
+DWELL_RADIUS_M = 50
+DWELL_MIN_SECONDS = 5 * 60
+
+# Clustering: 'kmeans' (full batch), 'minibatch' (persisted, incrementally updated model),
+# 'dbscan' or 'hdbscan' (density-based stop detection). CLUSTER_PER_USER clusters each
+# user separately, in parallel.
+CLUSTER_METHOD = os.getenv('CLUSTER_METHOD', 'kmeans')
+CLUSTER_PER_USER = os.getenv('CLUSTER_PER_USER', '0') == '1'
+CLUSTER_MODEL_FILE = 'cluster_model.pkl'
+CLUSTER_BATCH_SIZE = 1024
+STOP_EPS_M = 100
+STOP_MIN_SAMPLES = 3
+
+# Cluster centres match route waypoints within this distance.
+MATCH_RADIUS_M = float(os.getenv('MATCH_RADIUS_M', 100))
+
+
 def preprocess_geodata(df):
     df['Time'] = pd.to_datetime(df['Time'])
-    df = df.sort_values(by=['Time'])
-    df['geometry'] = df.apply(lambda row: Point(row['Longitude'], row['Latitude']), axis=1)
-    return df
+    df = df.sort_values(by=['user_id', 'Time'], kind='stable', ignore_index=True)
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['Longitude'], df['Latitude']))
 
 
-def analyze_movement(df):
-    df['next_point'] = df['geometry'].shift(-1)
-    df['distance'] = df.apply(
-        lambda row: row['geometry'].distance(row['next_point']) if pd.notnull(row['next_point']) else 0, axis=1)
-    df['time_diff'] = df['Time'].diff().dt.total_seconds().shift(-1)
-    df['speed'] = df.apply(lambda row: row['distance'] / row['time_diff'] if row['time_diff'] > 0 else 0, axis=1)
+# Per-user step to the next point: distance (m, haversine), time_diff (s), speed (m/s),
+# acceleration (m/s^2) and a dwell flag. The last point of each user gets distance and
+# speed 0 and NaN time_diff.
+@metrics.timed()
+def analyze_movement(df, dwell_radius=DWELL_RADIUS_M, dwell_min_seconds=DWELL_MIN_SECONDS):
+    following = df.groupby('user_id', sort=False)[['Latitude', 'Longitude', 'Time']].shift(-1)
+    distance = haversine_np(df['Latitude'].to_numpy(), df['Longitude'].to_numpy(),
+                            following['Latitude'].to_numpy(), following['Longitude'].to_numpy()) * 1000
+    df['distance'] = np.nan_to_num(distance, nan=0.0)
+    df['time_diff'] = (following['Time'] - df['Time']).dt.total_seconds()
+    time_diff = df['time_diff'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['speed'] = np.where(time_diff > 0, df['distance'].to_numpy() / time_diff, 0.0)
+        next_speed = df.groupby('user_id', sort=False)['speed'].shift(-1).to_numpy()
+        df['acceleration'] = np.where(time_diff > 0, (next_speed - df['speed'].to_numpy()) / time_diff, np.nan)
+    df['dwell'] = (df['distance'] <= dwell_radius) & (df['time_diff'] >= dwell_min_seconds)
     return df
 
 
-def cluster_user_trajectories(df, n_clusters=5):
+def cluster_user_trajectories(df, n_clusters=5, method=None, per_user=None, workers=None,
+                              model_path=CLUSTER_MODEL_FILE):
+    method = method or CLUSTER_METHOD
+    per_user = CLUSTER_PER_USER if per_user is None else per_user
+    if per_user:
+        df['cluster'] = cluster_per_user(df, n_clusters, method, workers)
+        return df, None
+    if method == 'minibatch':
+        model = update_cluster_model(df, n_clusters, model_path)
+        if not hasattr(model['kmeans'], 'cluster_centers_'):
+            print(f"Cluster model not trained yet: {len(df)} points, fewer than {n_clusters} clusters")
+            df['cluster'] = -1
+            return df, None
+        df['cluster'] = model['kmeans'].predict(model['scaler'].transform(df[['Longitude', 'Latitude']].values))
+        return df, model['kmeans']
+    if method in ('dbscan', 'hdbscan'):
+        df['cluster'] = detect_stops(df, method=method)
+        return df, None
     coords = df[['Longitude', 'Latitude']].values
     scaler = StandardScaler()
     coords_scaled = scaler.fit_transform(coords)
@@ -37,68 +92,184 @@ def cluster_user_trajectories(df, n_clusters=5):
     return df, kmeans
 
 
+# Incrementally train the persisted MiniBatchKMeans model on points it has not seen.
+# The model keeps the trained time range per user, so a new user's history (however
+# old) and points before or after a known user's range are trained on; points inside
+# a user's trained range count as seen. The scaler is fitted once, on the first batch
+# that trains the model, so centroids stay in the same feature space across updates.
+# Nothing is recorded or saved until partial_fit has run.
+def update_cluster_model(df, n_clusters=5, path=CLUSTER_MODEL_FILE, batch_size=CLUSTER_BATCH_SIZE):
+    try:
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        model = {'scaler': None, 'kmeans': MiniBatchKMeans(n_clusters=n_clusters, random_state=0,
+                                                           batch_size=batch_size, n_init=3)}
+    trained = model.setdefault('trained', {})  # user_id -> (first Time, last Time)
+    ranges = pd.DataFrame.from_dict(trained, orient='index', columns=['first', 'last'])
+    ranges = ranges.reindex(df['user_id'].to_numpy())
+    first, last = (pd.to_datetime(ranges[column]).to_numpy(dtype='datetime64[ns]') for column in ('first', 'last'))
+    times = df['Time'].to_numpy(dtype='datetime64[ns]')
+    new = df[np.isnat(first) | (times < first) | (times > last)]
+    fitted = hasattr(model['kmeans'], 'cluster_centers_')
+    if len(new) == 0 or (not fitted and len(new) < n_clusters):
+        return model
+
+    coords = new[['Longitude', 'Latitude']].values
+    if model['scaler'] is None:
+        model['scaler'] = StandardScaler().fit(coords)
+    coords_scaled = model['scaler'].transform(coords)
+    for begin in range(0, len(coords_scaled), batch_size):
+        batch = coords_scaled[begin:begin + batch_size]
+        if len(batch) >= n_clusters or hasattr(model['kmeans'], 'cluster_centers_'):
+            model['kmeans'].partial_fit(batch)
+
+    for user_id, span in new.groupby('user_id', sort=False)['Time'].agg(['min', 'max']).iterrows():
+        previous = trained.get(user_id)
+        trained[user_id] = (span['min'], span['max']) if previous is None else \
+            (min(previous[0], span['min']), max(previous[1], span['max']))
+    with open(path, 'wb') as f:
+        pickle.dump(model, f)
+    return model
+
+
+# Density-based stop detection on haversine distances (ball tree). Returns a label per
+# row; -1 marks points that are not part of any stop.
+def detect_stops(df, method='dbscan', eps_m=STOP_EPS_M, min_samples=STOP_MIN_SAMPLES):
+    coords = np.radians(df[['Latitude', 'Longitude']].to_numpy(dtype=float))
+    if len(coords) < min_samples:
+        return np.full(len(coords), -1)
+    if method == 'hdbscan':
+        model = HDBSCAN(min_cluster_size=min_samples, metric='haversine', algorithm='ball_tree')
+    else:
+        model = DBSCAN(eps=eps_m / EARTH_RADIUS_M, min_samples=min_samples, metric='haversine',
+                       algorithm='ball_tree')
+    return model.fit_predict(coords)
+
+
+# Cluster one user's points. Runs in a worker process.
+def _cluster_one_user(args):
+    coords, n_clusters, method = args
+    frame = pd.DataFrame(coords, columns=['Latitude', 'Longitude'])
+    if method in ('dbscan', 'hdbscan'):
+        return detect_stops(frame, method=method)
+    k = min(n_clusters, len(frame))
+    coords_scaled = StandardScaler().fit_transform(frame[['Longitude', 'Latitude']].values)
+    if method == 'minibatch':
+        return MiniBatchKMeans(n_clusters=k, random_state=0, n_init=3).fit_predict(coords_scaled)
+    return KMeans(n_clusters=k, random_state=0).fit_predict(coords_scaled)
+
+
+# Cluster every user separately, in parallel. Labels are offset per user so they are
+# unique across users; -1 (noise) is kept as is.
+def cluster_per_user(df, n_clusters=5, method='kmeans', workers=None):
+    workers = workers or int(os.getenv('CLUSTER_WORKERS', os.cpu_count() or 1))
+    groups = list(df.groupby('user_id', sort=False).indices.items())
+    tasks = [(df[['Latitude', 'Longitude']].to_numpy(dtype=float)[rows], n_clusters, method) for _, rows in groups]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+            results = list(executor.map(_cluster_one_user, tasks))
+    else:
+        results = [_cluster_one_user(task) for task in tasks]
+
+    labels = np.full(len(df), -1)
+    offset = 0
+    for (_, rows), user_labels in zip(groups, results):
+        labels[rows] = np.where(user_labels >= 0, user_labels + offset, -1)
+        offset += max(int(user_labels.max()) + 1, 0) if len(user_labels) else 0
+    return labels
+
+
 def generate_representative_routes(df):
     numeric_cols = ['Longitude', 'Latitude']
-    clusters = df.groupby('cluster')
+    clusters = df[df['cluster'] >= 0].groupby('cluster')
     representative_routes = clusters[numeric_cols].mean()
     return representative_routes
 
 
-def match_routes_to_optimized(representative_routes, optimized_route):
-    matched_routes = []
-    for idx, row in representative_routes.iterrows():
-        matched = optimized_route[
-            ((optimized_route['Longitude'] - row['Longitude']).abs() < 0.001) &
-            ((optimized_route['Latitude'] - row['Latitude']).abs() < 0.001)
-            ]
-        matched_routes.append(matched)
-    return pd.concat(matched_routes)
+# Join cluster centres to route rows whose waypoint is within max_distance_m, in one
+# BallTree (haversine) query over the distinct waypoints. Rows come back grouped by
+# centre, with the centre in 'cluster' and the distance in meters in 'match_distance'.
+@metrics.timed()
+def match_routes_to_optimized(representative_routes, optimized_route, max_distance_m=MATCH_RADIUS_M):
+    coords = optimized_route[['Latitude', 'Longitude']].to_numpy(dtype=float)
+    if len(coords) == 0 or len(representative_routes) == 0:
+        return optimized_route.iloc[:0].assign(cluster=pd.Series(dtype='int64'),
+                                               match_distance=pd.Series(dtype='float64'))
+    waypoints, waypoint_of_row = np.unique(coords, axis=0, return_inverse=True)
+    waypoint_of_row = waypoint_of_row.ravel()
+    rows_by_waypoint = np.argsort(waypoint_of_row, kind='stable')
+    rows_start = np.searchsorted(waypoint_of_row[rows_by_waypoint], np.arange(len(waypoints)))
+    rows_count = np.bincount(waypoint_of_row, minlength=len(waypoints))
+
+    tree = BallTree(np.radians(waypoints), metric='haversine')
+    centres = np.radians(representative_routes[['Latitude', 'Longitude']].to_numpy(dtype=float))
+    ind, dist = tree.query_radius(centres, r=max_distance_m / EARTH_RADIUS_M, return_distance=True)
 
+    # Expand (centre, waypoint) matches to (centre, route row).
+    centre = np.repeat(np.arange(len(centres)), [len(i) for i in ind])
+    waypoint = np.concatenate(ind).astype(int)
+    distance = np.concatenate(dist) * EARTH_RADIUS_M
+    counts = rows_count[waypoint]
+    position = np.repeat(rows_start[waypoint] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    rows = rows_by_waypoint[position]
+    centre = np.repeat(centre, counts)
+    order = np.lexsort((rows, centre))
 
-def generate_generalized_timetable(matched_routes):
-    matched_routes['scheduled'] = pd.to_datetime(matched_routes['scheduled'])
-    matched_routes['expected'] = pd.to_datetime(matched_routes['expected'])
-    generalized_timetable = matched_routes.groupby(['site_id', 'line_id', 'destination']).agg({
-        'scheduled': 'mean',
-        'expected': 'mean',
-        'transport_mode': 'first'
-    }).reset_index()
-    return generalized_timetable
+    matched = optimized_route.iloc[rows[order]].copy()
+    matched['cluster'] = representative_routes.index.to_numpy()[centre[order]]
+    matched['match_distance'] = np.repeat(distance, counts)[order]
+    return matched
 
 
-def user_patterns():
+# Merge the matched departures into the persisted timetable statistics and return
+# the timetable over everything seen so far (pass state_path=None for this batch only).
+def generate_generalized_timetable(matched_routes, state_path=TIMETABLE_STATE_FILE):
+    aggregator = TimetableAggregator() if state_path is None else TimetableAggregator.load(state_path)
+    merged = aggregator.update(matched_routes)
+    print(f"Timetable: merged {merged} new departures into {len(aggregator)} keys")
+    if state_path is not None:
+        aggregator.save(state_path)
+    return aggregator.to_frame()
+
+
+# Load the points to analyze. Subsets by user or time range are read from the
+# memory-mapped trajectory store instead of the full table.
+def load_user_data(users=None, start=None, end=None):
+    if users is None and start is None and end is None:
+        return storage.load_table('all_user_data', columns=['Latitude', 'Longitude', 'Time', 'user_id'])
+    return trajectory_store.TrajectoryStore().get_users(users, start, end)
+
+
+def user_patterns(users=None, start=None, end=None):
     user_profiles_folder = 'user_profiles'
-    all_user_data = pd.read_pickle('all_user_data.pkl')
+    all_user_data = load_user_data(users, start, end)
 
-    if all_user_data is not None:
-        print("All user data:", all_user_data.head())
+    metrics.inc('rows_processed_total', len(all_user_data), stage='user_patterns')
+    payload_log.debug("All user data: %s", all_user_data)
 
     all_user_data = preprocess_geodata(all_user_data)
     aggregated_data = analyze_movement(all_user_data)
     clustered_data, kmeans_model = cluster_user_trajectories(aggregated_data)
     representative_routes = generate_representative_routes(clustered_data)
-    print("Representative Routes DataFrame:", representative_routes.head())
+    payload_log.debug("Representative routes: %s", representative_routes)
 
     # Load optimized route
     try:
-        with open('optimized_route.pkl', 'rb') as f:
-            optimized_route = pickle.load(f)
+        optimized_route = storage.load_table('optimized_route')
     except Exception as e:
-        print(f"Error loading optimized_route.pkl: {e}")
+        print(f"Error loading optimized route: {e}")
         return
 
-    if isinstance(optimized_route, list):
-        optimized_route = pd.DataFrame(optimized_route)
-    print("Optimized Route DataFrame:", optimized_route.head())
-
     optimized_route.rename(columns={'waypoint_lon': 'Longitude', 'waypoint_lat': 'Latitude'}, inplace=True)
-    print("Adjusted Optimized Route DataFrame:", optimized_route.head())
+    payload_log.debug("Optimized route: %s", optimized_route)
 
     matched_routes = match_routes_to_optimized(representative_routes, optimized_route)
-    print("Matched Routes DataFrame:", matched_routes.head())
+    print(f"Matched {len(matched_routes)} route entries to {len(representative_routes)} representative routes")
+    payload_log.debug("Matched routes: %s", matched_routes)
 
     generalized_optimized_timetable = generate_generalized_timetable(matched_routes)
-    print("Generalized Optimized Timetable:", generalized_optimized_timetable)
+    payload_log.debug("Generalized optimized timetable: %s", generalized_optimized_timetable)
 
-    generalized_optimized_timetable.to_pickle('generalized_optimized_timetable.pkl')
+    storage.save_table(generalized_optimized_timetable, 'generalized_optimized_timetable')
 
@@ -2,4 +2,4 @@ import gtfs.regen_trajectories as regen
 
 
 if __name__ == '__main__':
-    regen
+    regen.main()
@@ -1,54 +1,152 @@
 import os
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point
 import xml.etree.ElementTree as ET
+import logging
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
+import storage
+import trajectory_store
+import metrics
 
 
 # __Author__: pablo-chacon
 # __Version__: 1.0.3
 # __Date__: 2024-06-01
 
-def parse_gpx(gpx_file_path):
-    tree = ET.parse(gpx_file_path)
-    root = tree.getroot()
-    ns = {'default': 'http://www.topografix.com/GPX/1/1'}
-    data = []
-    for trkpt in root.findall('.//default:trkpt', ns):
-        lat = float(trkpt.get('lat'))
-        lon = float(trkpt.get('lon'))
-        time = trkpt.find('default:time', ns).text
-        data.append([lat, lon, time])
-    return pd.DataFrame(data, columns=['Latitude', 'Longitude', 'Time'])
-
-
+GPX_CHUNK_SIZE = 100_000
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+# Stream track points as chunks of (lat float64, lon float64, time datetime64[ns]) arrays.
+# Namespace-agnostic (GPX 1.0/1.1), walks every track and segment, missing <time> -> NaT.
+# Finished points are detached from the tree so memory stays bounded by chunk_size.
+def iter_gpx_chunks(gpx_file_path, chunk_size=GPX_CHUNK_SIZE):
+    lats = np.empty(chunk_size, dtype='float64')
+    lons = np.empty(chunk_size, dtype='float64')
+    times = []
+    parents = []
+    for event, elem in ET.iterparse(gpx_file_path, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if _local_name(elem.tag) != 'trkpt':
+            continue
+        time = None
+        for child in elem:
+            if _local_name(child.tag) == 'time':
+                time = child.text
+                break
+        n = len(times)
+        lats[n] = float(elem.get('lat'))
+        lons[n] = float(elem.get('lon'))
+        times.append(time)
+        if parents:
+            parents[-1].remove(elem)
+        if len(times) == chunk_size:
+            yield _gpx_chunk(lats, lons, times)
+            times = []
+    if times:
+        yield _gpx_chunk(lats, lons, times)
+
+
+def _gpx_chunk(lats, lons, times):
+    n = len(times)
+    parsed = pd.to_datetime(pd.Series(times, dtype='object'), utc=True, format='ISO8601')
+    return lats[:n].copy(), lons[:n].copy(), parsed.dt.tz_localize(None).to_numpy(dtype='datetime64[ns]')
+
+
+def parse_gpx(gpx_file_path, chunk_size=GPX_CHUNK_SIZE):
+    chunks = list(iter_gpx_chunks(gpx_file_path, chunk_size))
+    if not chunks:
+        return pd.DataFrame({'Latitude': pd.Series(dtype='float64'), 'Longitude': pd.Series(dtype='float64'),
+                             'Time': pd.Series(dtype='datetime64[ns]')})
+    lats, lons, times = (np.concatenate(parts) for parts in zip(*chunks))
+    return pd.DataFrame({'Latitude': lats, 'Longitude': lons, 'Time': times})
+
+
+# Flag each user's last point as their destination.
 def identify_destinations(gdf):
     gdf['is_destination'] = False
-    gdf.loc[gdf.index[-1], 'is_destination'] = True
+    gdf.loc[gdf.groupby('user_id', sort=False).tail(1).index, 'is_destination'] = True
     return gdf
 
 
-def process_user_trajectories():
-    gpx_folder = os.path.join(os.path.dirname(__file__), 'user_profiles')
-    user_profiles = []
-    for filename in os.listdir(gpx_folder):
-        if filename.endswith('.gpx'):
-            gpx_file_path = os.path.join(gpx_folder, filename)
-            df = parse_gpx(gpx_file_path)
-            df['user_id'] = filename
-            user_profiles.append(df)
+# Parse one user's GPX file. Runs in a worker process, so failures are returned, not raised.
+def _parse_user_file(gpx_file_path):
+    filename = os.path.basename(gpx_file_path)
+    try:
+        df = parse_gpx(gpx_file_path)
+        df['user_id'] = filename
+        return filename, df, None
+    except Exception as e:
+        return filename, None, f"{type(e).__name__}: {e}"
+
+
+# Raised when no GPX file in the folder could be parsed. failures: {filename: error}.
+class IngestError(Exception):
+    def __init__(self, message, failures=None):
+        super().__init__(message)
+        self.failures = failures or {}
+
+
+# Parse every .gpx in the folder, in parallel when workers > 1.
+# Returns per-file frames in sorted filename order and {filename: error} for files that failed.
+def ingest_user_profiles(gpx_folder, workers=None):
+    workers = workers or int(os.getenv('INGEST_WORKERS', os.cpu_count() or 1))
+    paths = [os.path.join(gpx_folder, filename) for filename in sorted(os.listdir(gpx_folder))
+             if filename.endswith('.gpx')]
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+            results = list(executor.map(_parse_user_file, paths, chunksize=max(1, len(paths) // (workers * 4))))
+    else:
+        results = [_parse_user_file(path) for path in paths]
+    frames = [df for _, df, _ in results if df is not None]
+    failures = {filename: error for filename, _, error in results if error is not None}
+    for filename, error in failures.items():
+        logging.warning(f"Failed to parse {filename}: {error}")
+    return frames, failures
+
+
+# Parse the folder into one trajectory table. Returns (gdf, gdf with destinations flagged,
+# {filename: error} of the files that failed); raises IngestError if none could be parsed.
+def process_user_trajectories(workers=None, gpx_folder=None):
+    gpx_folder = gpx_folder or os.path.join(os.path.dirname(__file__), 'user_profiles')
+    user_profiles, failures = ingest_user_profiles(gpx_folder, workers)
+    if not user_profiles:
+        detail = f": {failures}" if failures else ""
+        raise IngestError(f"No GPX files could be parsed in {gpx_folder}{detail}", failures)
     df = pd.concat(user_profiles, ignore_index=True)
     df['Time'] = pd.to_datetime(df['Time'])
+    df = df.sort_values(['user_id', 'Time'], kind='stable', ignore_index=True)
     gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.Longitude, df.Latitude))
-    total_distance = 0
-    for i in range(len(gdf) - 1):
-        lat1, lon1 = gdf.iloc[i].Latitude, gdf.iloc[i].Longitude
-        lat2, lon2 = gdf.iloc[i + 1].Latitude, gdf.iloc[i + 1].Longitude
-        total_distance += haversine_distance(lat1, lon1, lat2, lon2)
-    gdf['TimeDelta'] = gdf['Time'].diff().dt.total_seconds() / 3600
-    gdf['Speed'] = total_distance / gdf['TimeDelta']
-    return gdf, identify_destinations(gdf)
+    gdf = add_segment_columns(gdf)
+    return gdf, identify_destinations(gdf), failures
+
+
+# Per-user segment from the previous point: Distance (km), TimeDelta (hours), Speed (km/h).
+# The first point of each user has NaN in all three. Rows must be time-sorted within user.
+def add_segment_columns(df):
+    previous = df.groupby('user_id', sort=False)[['Latitude', 'Longitude', 'Time']].shift()
+    df['Distance'] = haversine_np(previous['Latitude'].to_numpy(), previous['Longitude'].to_numpy(),
+                                  df['Latitude'].to_numpy(), df['Longitude'].to_numpy())
+    df['TimeDelta'] = (df['Time'] - previous['Time']).dt.total_seconds() / 3600
+    df['Speed'] = (df['Distance'] / df['TimeDelta']).replace([np.inf, -np.inf], np.nan)
+    return df
+
+
+# Vectorized haversine over arrays of coordinates, in km.
+def haversine_np(lat1, lon1, lat2, lon2):
+    R = 6371.0  # Earth radius in km.
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
 
 
 def haversine_distance(lat1, lon1, lat2, lon2):
@@ -63,26 +161,71 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     return distance
 
 
+# Start of the window for every row: each user's first point, or a fixed timestamp.
+def _window_anchor(df, anchor, by):
+    if isinstance(anchor, str) and anchor == 'first':
+        return df.groupby(by)['Time'].transform('min')
+    return pd.Series(pd.Timestamp(anchor), index=df.index)
+
+
+# Rows within `duration` (inclusive) after the anchor, in one vectorized pass.
+def window_from_anchor(df, duration, anchor='first', by='user_id'):
+    offset = df['Time'] - _window_anchor(df, anchor, by)
+    return df[(offset >= pd.Timedelta(0)) & (offset <= pd.Timedelta(duration))]
+
+
+# Assign rows to half-open [start, start + duration) windows counted from the anchor.
+# step == duration (default) gives tumbling windows; step < duration gives sliding
+# windows, where a row is repeated once per window containing it. Adds 'window'
+# (index from the anchor) and 'window_start' columns.
+def time_windows(df, duration, step=None, anchor='first', by='user_id'):
+    duration_ns = pd.Timedelta(duration).value
+    step_ns = pd.Timedelta(step).value if step is not None else duration_ns
+    start = _window_anchor(df, anchor, by)
+    delta = df['Time'] - start
+    offset = delta.to_numpy(dtype='timedelta64[ns]').astype('int64')
+    valid = delta.notna().to_numpy() & (offset >= 0)
+    positions = np.flatnonzero(valid)
+    offset = offset[positions]
+
+    last = offset // step_ns
+    first = np.maximum((offset - duration_ns) // step_ns + 1, 0)
+    counts = np.maximum(last - first + 1, 0)
+    rows = np.repeat(positions, counts)
+    window = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    windows = df.iloc[rows].copy()
+    windows['window'] = window
+    windows['window_start'] = start.to_numpy()[rows] + (window * step_ns).astype('timedelta64[ns]')
+    return windows
+
+
 def regenerate_48_hour_movements(all_user_data):
-    regenerated_data = pd.DataFrame()
-    for user_id, group in all_user_data.groupby('user_id'):
-        start_time = group['Time'].min()
-        end_time = start_time + timedelta(hours=48)
-        pattern_data = group[(group['Time'] >= start_time) & (group['Time'] <= end_time)]
-        regenerated_data = pd.concat([regenerated_data, pattern_data])
-    return regenerated_data
+    pattern_data = window_from_anchor(all_user_data, timedelta(hours=48))
+    return pattern_data.sort_values('user_id', kind='stable')
+
+
+# Destination points only, as a small table.
+def destinations_table(gdf):
+    return pd.DataFrame(gdf.loc[gdf['is_destination'], ['user_id', 'Latitude', 'Longitude', 'Time']])
 
 
-def user_trajectory():
-    gdf, destinations = process_user_trajectories()
-    gdf.to_pickle('all_user_data.pkl')
-    destinations.to_pickle('dest.pkl')
+# Returns {filename: error} of the GPX files that could not be parsed.
+def user_trajectory(gpx_folder=None):
+    gdf, destinations, failures = process_user_trajectories(gpx_folder=gpx_folder)
+    if failures:
+        logging.warning(f"Skipped {len(failures)} GPX files that could not be parsed: {sorted(failures)}")
+        metrics.inc('gpx_files_failed_total', len(failures))
+    storage.save_table(gdf, 'all_user_data')
+    storage.save_table(destinations_table(destinations), 'destinations')
+    trajectory_store.build_trajectory_store(gdf)
 
     # Regenerate 48-hour movements.
-    regenerated_data = regenerate_48_hour_movements(pd.read_pickle('all_user_data.pkl'))
+    regenerated_data = regenerate_48_hour_movements(gdf)
 
     # Save regenerated data.
-    regenerated_data.to_pickle('regenerated_48_hour_data.pkl')
+    storage.save_table(regenerated_data, 'regenerated_48_hour_data')
+    return failures
 
 
 if __name__ == '__main__':
@@ -17,11 +17,12 @@ setup(
         'streamlit-folium',
         'geopy',
         'shapely',
-        'scikit-learn',
+        'scikit-learn>=1.3',
         'matplotlib',
         'python-dotenv',
         'requests',
-        'gpxpy'
+        'gpxpy',
+        'pyarrow'
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import pytest
+
+# The gtfs modules import each other by plain module name.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gtfs'))
+
+import metrics  # noqa: E402
+
+
+# Every test runs in its own working (data) directory with empty metrics.
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics.registry.reset()
+    yield tmp_path
+    metrics.registry.reset()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, query, dict(self.headers)))
+        route = self.server.routes.get(url.path)
+        status, body, headers = route(url.path, query, self.headers) if route else (404, {'error': 'not found'}, {})
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Local stand-in for the SL API. routes maps a path to handler(path, query, headers)
+# returning (status, body, headers); requests records (path, query, headers).
+class StubServer:
+    def __init__(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.routes = {}
+        self.httpd.requests = []
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self._thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+
+    @property
+    def routes(self):
+        return self.httpd.routes
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# sl_rtd pointed at a stub server over real HTTP, without retries and with an empty cache.
+@pytest.fixture
+def sl_stub(monkeypatch):
+    import sl_rtd as sl
+    import sl_transport
+
+    server = StubServer()
+    monkeypatch.setattr(sl, 'sites_url', f'{server.url}/v1/sites')
+    monkeypatch.setattr(sl, 'departures_url_template', f'{server.url}/v1/sites/{{site_id}}/departures')
+    monkeypatch.setattr(sl, 'request_retries', 0)
+    monkeypatch.setattr(sl, '_session', None)
+    previous = sl.set_transport(sl_transport.HTTPTransport(sl.get_session))
+    sl.departure_cache.clear()
+    yield server
+    sl.set_transport(previous)
+    sl.departure_cache.clear()
+    server.close()
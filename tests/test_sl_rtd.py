@@ -0,0 +1,223 @@
+import threading
+import time
+import sl_rtd as sl
+
+
+def departures_body(site_id):
+    return {'departures': [{'site_id': site_id, 'line': {'id': 1}, 'destination': 'Centralen'}]}
+
+
+def site_route(path):
+    return path.split('/')[-2]
+
+
+def test_fetch_departures_many_runs_concurrently(sl_stub):
+    lock = threading.Lock()
+    state = {'in_flight': 0, 'peak': 0}
+
+    def departures(path, query, headers):
+        with lock:
+            state['in_flight'] += 1
+            state['peak'] = max(state['peak'], state['in_flight'])
+        time.sleep(0.1)
+        with lock:
+            state['in_flight'] -= 1
+        return 200, departures_body(site_route(path)), {}
+
+    site_ids = [str(1000 + i) for i in range(8)]
+    for site_id in site_ids:
+        sl_stub.routes[f'/v1/sites/{site_id}/departures'] = departures
+
+    result = sl.fetch_departures_many(site_ids, time_window=30, max_workers=4)
+
+    assert list(result) == site_ids
+    assert all(result[site_id][0]['site_id'] == site_id for site_id in site_ids)
+    assert 1 < state['peak'] <= 4
+    assert all(query == {'forecast': '30'} for _, query, _ in sl_stub.requests)
+
+
+def test_fetch_departures_many_isolates_failures(sl_stub):
+    def ok(path, query, headers):
+        return 200, departures_body(site_route(path)), {}
+
+    def broken(path, query, headers):
+        return 500, {'error': 'boom'}, {}
+
+    sl_stub.routes['/v1/sites/1/departures'] = ok
+    sl_stub.routes['/v1/sites/2/departures'] = broken
+    sl_stub.routes['/v1/sites/4/departures'] = ok  # 3 is not routed: 404
+
+    result = sl.fetch_departures_many(['1', '2', '3', '4', '1'])
+
+    assert list(result) == ['1', '2', '3', '4']
+    assert result['2'] == [] and result['3'] == []
+    assert result['1'][0]['site_id'] == '1' and result['4'][0]['site_id'] == '4'
+    # Failures are not cached as sites without departures.
+    assert sl.cached_departures('2') is None
+    assert sl.cached_departures('1') == result['1']
+
+
+def test_fetch_departures_many_survives_connection_errors(sl_stub, monkeypatch):
+    monkeypatch.setattr(sl, 'departures_url_template', 'http://127.0.0.1:1/v1/sites/{site_id}/departures')
+
+    assert sl.fetch_departures_many(['1', '2']) == {'1': [], '2': []}
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def test_departure_cache_expires_after_ttl():
+    cache = sl.DepartureCache(ttl=0.05)
+    calls = []
+    fetch = lambda: calls.append(1) or len(calls)  # noqa: E731
+
+    assert cache.get_or_fetch('a', fetch) == 1
+    assert cache.get_or_fetch('a', fetch) == 1
+    assert cache.get('a') == 1
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    assert cache.get_or_fetch('a', fetch) == 2
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'coalesced': 0, 'size': 1}
+
+
+def test_departure_cache_evicts_least_recently_used():
+    cache = sl.DepartureCache(ttl=60, maxsize=2)
+    cache.get_or_fetch('a', lambda: 'A')
+    cache.get_or_fetch('b', lambda: 'B')
+    cache.get('a')  # 'b' is now the least recently used
+    cache.get_or_fetch('c', lambda: 'C')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A' and cache.get('c') == 'C'
+    assert cache.stats()['size'] == 2
+
+
+def test_departure_cache_coalesces_concurrent_misses():
+    cache = sl.DepartureCache(ttl=60)
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(2)
+        return ['departure']
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch('a', fetch))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: cache.stats()['coalesced'] == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [['departure']] * 5
+    assert cache.stats()['misses'] == 1
+
+
+def test_departure_cache_does_not_cache_failures():
+    cache = sl.DepartureCache(ttl=60)
+    release = threading.Event()
+
+    def failing():
+        release.wait(2)
+        raise sl.DeparturesUnavailable('down')
+
+    errors = []
+
+    def lookup():
+        try:
+            cache.get_or_fetch('a', failing)
+        except sl.DeparturesUnavailable as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookup) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: cache.stats()['coalesced'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 3
+    assert cache.get('a') is None
+    assert cache.get_or_fetch('a', lambda: []) == []
+
+
+def test_fetch_departures_uses_cache(sl_stub):
+    sl_stub.routes['/v1/sites/1/departures'] = lambda path, query, headers: (200, departures_body('1'), {})
+
+    first = sl.fetch_departures('1', time_window=15)
+    assert sl.fetch_departures('1', time_window=15) == first
+    sl.fetch_departures('1', time_window=30)
+    sl.fetch_departures('1', time_window=15, use_cache=False)
+
+    assert [query['forecast'] for _, query, _ in sl_stub.requests] == ['15', '30', '15']
+
+
+SITES = [{'id': 1002, 'name': 'Centralen', 'lat': 59.331, 'lon': 18.059},
+         {'id': 9001, 'name': 'Slussen', 'lat': 59.320, 'lon': 18.072}]
+
+
+# Serves body with an ETag, answering 304 when the client already has it (unless etag=False).
+def sites_route(sites, etag=True):
+    def route(path, query, headers):
+        tag = f'"{len(sites)}-{sites[0]["name"]}"'
+        if etag and headers.get('If-None-Match') == tag:
+            return 304, b'', {'ETag': tag}
+        return 200, sites, {'ETag': tag} if etag else {}
+    return route
+
+
+def test_fetch_sites_writes_catalogue_index_and_validators(sl_stub, workdir):
+    sl_stub.routes['/v1/sites'] = sites_route(SITES)
+
+    assert sl.fetch_and_save_sites_data() is True
+
+    assert sl.load_sites_data()['name'].tolist() == ['Centralen', 'Slussen']
+    assert len(sl.load_sites_index()) == 2
+    meta = sl.load_sites_meta()
+    assert meta['etag'] == '"2-Centralen"' and len(meta['sha256']) == 64
+    # Fresh copy: no request at all.
+    assert sl.fetch_and_save_sites_data() is False
+    assert len(sl_stub.requests) == 1
+
+
+def test_fetch_sites_not_modified_keeps_files(sl_stub, workdir):
+    sl_stub.routes['/v1/sites'] = sites_route(SITES)
+    sl.fetch_and_save_sites_data()
+    mtime = (workdir / 'sites_data.pkl').stat().st_mtime_ns
+    fetched_at = sl.load_sites_meta()['fetched_at']
+
+    assert sl.fetch_and_save_sites_data(max_age=0) is False
+
+    assert sl_stub.requests[-1][2]['If-None-Match'] == '"2-Centralen"'
+    assert (workdir / 'sites_data.pkl').stat().st_mtime_ns == mtime
+    assert sl.load_sites_meta()['fetched_at'] > fetched_at
+
+
+def test_fetch_sites_unchanged_body_keeps_files(sl_stub, workdir):
+    sl_stub.routes['/v1/sites'] = sites_route(SITES, etag=False)
+    sl.fetch_and_save_sites_data()
+    mtime = (workdir / 'sites_data.pkl').stat().st_mtime_ns
+
+    assert sl.fetch_and_save_sites_data(max_age=0) is False
+    assert (workdir / 'sites_data.pkl').stat().st_mtime_ns == mtime
+
+    sl_stub.routes['/v1/sites'] = sites_route(SITES[:1], etag=False)
+    assert sl.fetch_and_save_sites_data(max_age=0) is True
+    assert sl.load_sites_data()['name'].tolist() == ['Centralen']
+
+
+def test_fetch_sites_failure_keeps_stored_copy(sl_stub, workdir):
+    sl_stub.routes['/v1/sites'] = sites_route(SITES)
+    sl.fetch_and_save_sites_data()
+    sl_stub.routes['/v1/sites'] = lambda path, query, headers: (500, {'error': 'boom'}, {})
+
+    assert sl.fetch_and_save_sites_data(force=True) is False
+    assert len(sl.load_sites_data()) == 2
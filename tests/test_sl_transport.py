@@ -0,0 +1,114 @@
+import gzip
+import hashlib
+import json
+import pytest
+import requests
+import sl_rtd as sl
+import sl_transport
+from sl_transport import RecordingTransport, ReplayTransport
+
+
+def departures_route(path, query, headers):
+    site_id = path.split('/')[-2]
+    return 200, {'departures': [{'site': site_id, 'forecast': query.get('forecast')}]}, {'ETag': f'"{site_id}"'}
+
+
+# Record the departures of the given sites through sl_rtd into the archive.
+def record(sl_stub, site_ids, path='archive.jsonl.gz'):
+    for site_id in site_ids:
+        sl_stub.routes[f'/v1/sites/{site_id}/departures'] = departures_route
+    recorder = RecordingTransport(sl_transport.HTTPTransport(sl.get_session), path)
+    previous = sl.set_transport(recorder)
+    try:
+        for site_id in site_ids:
+            sl.fetch_departures(site_id, time_window=30, use_cache=False)
+    finally:
+        sl.set_transport(previous)
+        recorder.close()
+    return path
+
+
+def archive_lines(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_request_key_ignores_host_and_orders_params():
+    key = sl_transport.request_key('https://transport.integration.sl.se/v1/sites/1002/departures',
+                                   {'transport': 'BUS', 'forecast': 30, 'line': None})
+
+    assert key == '/sites/1002/departures?forecast=30&transport=BUS'
+    assert key == sl_transport.request_key('http://127.0.0.1:8000/v1/sites/1002/departures/?transport=BUS',
+                                           {'forecast': '30'})
+    assert sl_transport.endpoint_key(key) == '/sites/{id}/departures'
+
+
+def test_recording_appends_each_body_once(sl_stub):
+    path = record(sl_stub, ['1', '2'])
+    record(sl_stub, ['1', '2'])
+
+    lines = archive_lines(path)
+    assert sum('sha256' in line for line in lines) == 2
+    assert [line['key'] for line in lines if 'key' in line] == ['/sites/1/departures?forecast=30',
+                                                              '/sites/2/departures?forecast=30'] * 2
+    assert len(ReplayTransport(path)) == 4
+
+
+def test_replay_serves_recorded_responses_offline(sl_stub):
+    path = record(sl_stub, ['1', '2'])
+    sl.set_transport(ReplayTransport(path))
+    sl_stub.requests.clear()
+
+    assert sl.fetch_departures_many(['1', '2'], time_window=30) == {
+        '1': [{'site': '1', 'forecast': '30'}], '2': [{'site': '2', 'forecast': '30'}]}
+    assert sl_stub.requests == []
+
+
+def test_replay_fallback_and_not_recorded(sl_stub):
+    path = record(sl_stub, ['1'])
+    url = 'http://replay/v1/sites/3/departures'
+
+    response = ReplayTransport(path).get(url, params={'forecast': 30})
+    assert response.status_code == 200 and response.json()['departures'][0]['site'] == '1'
+    assert ReplayTransport(path, fallback=False).get(url, params={'forecast': 30}).status_code == 404
+
+
+def test_replay_rotates_through_recorded_responses(workdir):
+    path = 'archive.jsonl.gz'
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for n in (1, 2):
+            body = json.dumps({'n': n})
+            digest = hashlib.sha256(body.encode('utf-8')).hexdigest()
+            f.write(json.dumps({'sha256': digest, 'data': body}) + '\n')
+            f.write(json.dumps({'key': '/sites', 'status': 200, 'elapsed': 0.25, 'headers': {},
+                                'body': digest, 'recorded_at': 0}) + '\n')
+    sleeps = []
+    replay = ReplayTransport(path, latency_ms='recorded', sleep=sleeps.append)
+
+    assert [replay.get('http://replay/v1/sites').json()['n'] for _ in range(3)] == [1, 2, 1]
+    assert sleeps == [0.25] * 3
+
+
+def test_replay_conditional_request(sl_stub):
+    replay = ReplayTransport(record(sl_stub, ['1']))
+    url = 'http://replay/v1/sites/1/departures'
+
+    assert replay.get(url, params={'forecast': 30}, headers={'If-None-Match': '"1"'}).status_code == 304
+    assert replay.get(url, params={'forecast': 30}, headers={'If-None-Match': '"2"'}).status_code == 200
+
+
+def test_replay_simulates_errors_timeouts_and_latency(sl_stub):
+    path = record(sl_stub, ['1'])
+    url = 'http://replay/v1/sites/1/departures'
+    sleeps = []
+
+    assert ReplayTransport(path, error_rate=1, sleep=sleeps.append).get(url).status_code == 503
+    with pytest.raises(requests.Timeout):
+        ReplayTransport(path, timeout_rate=1, sleep=sleeps.append).get(url, timeout=5)
+    assert sleeps == [0.0, 5]
+
+    sleeps.clear()
+    replay = ReplayTransport(path, latency_ms=100, latency_sigma=0.5, seed=1, sleep=sleeps.append)
+    for _ in range(200):
+        replay.get(url)
+    assert 0.08 < sorted(sleeps)[100] < 0.12
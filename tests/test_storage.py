@@ -0,0 +1,77 @@
+import os
+import pytest
+import pandas as pd
+import geopandas as gpd
+import storage
+
+
+def user_data():
+    return pd.DataFrame({
+        'user_id': ['b', 'a', 'a', 'b', 'a'],
+        'Latitude': [59.0, 59.1, 59.2, 59.3, 59.4],
+        'Longitude': [18.0, 18.1, 18.2, 18.3, 18.4],
+        'Time': pd.to_datetime(['2024-06-02 09:00', '2024-06-01 08:00', '2024-06-02 08:00',
+                                '2024-06-01 09:00', '2024-06-03 08:00']),
+    })
+
+
+def test_round_trip_partitioned_table(workdir):
+    storage.save_table(user_data(), 'all_user_data')
+
+    assert sorted(os.listdir(workdir / 'all_user_data.parquet')) == ['user_id=a', 'user_id=b']
+    df = storage.load_table('all_user_data')
+    assert list(df.columns) == ['Latitude', 'Longitude', 'Time', 'user_id']
+    assert df['user_id'].tolist() == ['a', 'a', 'a', 'b', 'b']
+    assert df.groupby('user_id')['Time'].apply(lambda t: t.is_monotonic_increasing).all()
+    assert df['Latitude'].tolist() == [59.1, 59.2, 59.4, 59.3, 59.0]
+
+
+def test_load_table_pushes_down_users_and_time_range(workdir):
+    storage.save_table(user_data(), 'all_user_data')
+
+    df = storage.load_table('all_user_data', columns=['user_id', 'Time'], users=['a'],
+                            start='2024-06-01 12:00', end='2024-06-02 23:59')
+
+    assert list(df.columns) == ['user_id', 'Time']
+    assert df.values.tolist() == [['a', pd.Timestamp('2024-06-02 08:00')]]
+
+
+def test_load_table_extra_filters_and_geometry(workdir):
+    storage.save_table(user_data(), 'optimized_route')
+
+    df = storage.load_table('optimized_route', columns=['user_id'], filters=[('Latitude', '>', 59.25)],
+                            geometry=True)
+
+    assert isinstance(df, gpd.GeoDataFrame)
+    assert df['user_id'].tolist() == ['b', 'a']
+    assert [(p.x, p.y) for p in df.geometry] == [(18.3, 59.3), (18.4, 59.4)]
+
+
+def test_save_table_replaces_previous_version(workdir):
+    storage.save_table(user_data(), 'all_user_data')
+    storage.save_table(user_data().iloc[:1], 'all_user_data')
+
+    assert storage.load_table('all_user_data')['user_id'].tolist() == ['b']
+    assert os.listdir(workdir) == ['all_user_data.parquet']
+
+    storage.save_table(user_data(), 'optimized_route')
+    storage.save_table([{'user_id': 'c', 'Latitude': 1.0, 'Longitude': 2.0}], 'optimized_route')
+    assert storage.load_table('optimized_route').to_dict('records') == [
+        {'user_id': 'c', 'Latitude': 1.0, 'Longitude': 2.0}]
+
+
+def test_save_table_stores_mixed_object_columns_as_strings(workdir):
+    storage.save_table(pd.DataFrame({'line': [1, 'N/A', None]}), 'mixed')
+
+    line = storage.load_table('mixed')['line']
+    assert line[:2].tolist() == ['1', 'N/A'] and pd.isna(line[2])
+
+
+def test_failed_save_keeps_previous_version(workdir):
+    storage.save_table(user_data(), 'all_user_data')
+
+    with pytest.raises(Exception):
+        storage.save_table(user_data().assign(bad=[object()] * 5), 'all_user_data')
+
+    assert len(storage.load_table('all_user_data')) == 5
+    assert os.listdir(workdir) == ['all_user_data.parquet']
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+import timetable
+from timetable import TimetableAggregator
+
+
+def departures(n=200, seed=0, start='2024-06-01 06:00'):
+    rng = np.random.default_rng(seed)
+    scheduled = pd.Timestamp(start) + pd.to_timedelta(np.arange(n) * 5, unit='min')
+    delay = rng.normal(60, 90, n).round()
+    return pd.DataFrame({
+        'site_id': rng.choice([1002, 9001], n),
+        'line_id': rng.choice([4, 17], n),
+        'destination': rng.choice(['Centralen', 'Slussen'], n),
+        'scheduled': scheduled.strftime('%Y-%m-%dT%H:%M:%S'),
+        'expected': (scheduled + pd.to_timedelta(delay, unit='s')).strftime('%Y-%m-%dT%H:%M:%S'),
+        'transport_mode': 'BUS',
+    })
+
+
+def test_update_in_batches_matches_single_batch():
+    data = departures()
+    whole = TimetableAggregator()
+    whole.update(data)
+    incremental = TimetableAggregator()
+    for batch in np.array_split(np.arange(len(data)), 4):
+        incremental.update(data.iloc[batch])
+
+    expected = whole.to_frame().sort_values(timetable.KEYS, ignore_index=True)
+    result = incremental.to_frame().sort_values(timetable.KEYS, ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-9)
+    assert expected['count'].sum() == len(data)
+
+
+def test_to_frame_statistics_match_observations():
+    data = departures()
+    aggregator = TimetableAggregator()
+    aggregator.update(data)
+
+    delay = (pd.to_datetime(data['expected']) - pd.to_datetime(data['scheduled'])).dt.total_seconds()
+    expected = delay.groupby([data[key] for key in timetable.KEYS]).agg(['mean', 'std', 'median', 'size'])
+    result = aggregator.to_frame().set_index(timetable.KEYS).loc[expected.index]
+    np.testing.assert_allclose(result['delay_mean'], expected['mean'])
+    population_std = expected['std'] * np.sqrt((expected['size'] - 1) / expected['size'])
+    np.testing.assert_allclose(result['delay_std'], population_std)
+    assert (result['count'] == expected['size']).all()
+    assert (np.abs(result['delay_p50'] - expected['median']) <= timetable.DELAY_BIN_SECONDS).all()
+
+
+def test_update_counts_each_departure_once():
+    data = departures(n=50)
+    aggregator = TimetableAggregator()
+
+    assert aggregator.update(pd.concat([data, data])) == 50
+    assert aggregator.update(data) == 0
+    assert aggregator.update(departures(n=10, start='2024-06-02 06:00')) == 10
+    assert aggregator.to_frame()['count'].sum() == 60
+
+
+def test_update_skips_unparseable_rows():
+    data = departures(n=3)
+    data.loc[2, 'expected'] = 'not a time'
+    data.loc[1, 'destination'] = None
+
+    assert TimetableAggregator().update(data) == 1
+
+
+def test_save_and_load_round_trip(workdir):
+    aggregator = TimetableAggregator()
+    aggregator.update(departures(n=20))
+    aggregator.save()
+
+    loaded = TimetableAggregator.load()
+    pd.testing.assert_frame_equal(loaded.to_frame(), aggregator.to_frame())
+    assert len(TimetableAggregator.load('missing.pkl')) == 0
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+import trajectory_store as ts
+
+
+@pytest.fixture
+def store(workdir):
+    df = pd.DataFrame({
+        'user_id': ['b', 'a', 'a', 'b', 'a'],
+        'Latitude': [2.0, 1.2, 1.0, 2.1, 1.1],
+        'Longitude': [20.0, 10.2, 10.0, 20.1, 10.1],
+        'Time': pd.to_datetime(['2024-06-01 09:00', '2024-06-01 10:00', '2024-06-01 08:00',
+                                '2024-06-02 09:00', '2024-06-01 09:00']),
+    })
+    ts.build_trajectory_store(df)
+    return ts.TrajectoryStore()
+
+
+def test_get_user_returns_time_sorted_memmap_views(store):
+    points = store.get_user('a')
+
+    np.testing.assert_array_equal(points['Latitude'], [1.0, 1.1, 1.2])
+    np.testing.assert_array_equal(points['Longitude'], [10.0, 10.1, 10.2])
+    assert points['Time'].dtype == 'datetime64[ns]'
+    assert all(isinstance(values, np.memmap) for values in points.values())
+    assert len(store) == 5 and store.users == ['a', 'b']
+
+
+def test_get_user_time_range_is_inclusive(store):
+    points = store.get_user('a', start='2024-06-01 09:00', end='2024-06-01 10:00')
+    np.testing.assert_array_equal(points['Latitude'], [1.1, 1.2])
+
+    assert len(store.get_user('a', start='2024-06-01 10:00:01')['Latitude']) == 0
+    assert len(store.get_user('a', end='2024-06-01 07:59')['Latitude']) == 0
+    np.testing.assert_array_equal(store.get_user('b', end='2024-06-01 23:00')['Latitude'], [2.0])
+
+
+def test_get_user_unknown_user_is_empty(store):
+    points = store.get_user('nobody')
+
+    assert all(len(values) == 0 for values in points.values())
+
+
+def test_get_users_matches_table_layout(store):
+    df = store.get_users(start='2024-06-01 09:00', end='2024-06-01 23:00')
+
+    assert list(df.columns) == ['Latitude', 'Longitude', 'Time', 'user_id']
+    assert df[['user_id', 'Latitude']].values.tolist() == [['a', 1.1], ['a', 1.2], ['b', 2.0]]
+    assert store.get_users(users=[]).empty
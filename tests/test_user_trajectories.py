@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+import user_trajectories as ut
+
+GPX_11 = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">
+  <trk><trkseg>
+    <trkpt lat="59.0" lon="18.0"><ele>10</ele><time>2024-06-01T08:00:00Z</time></trkpt>
+    <trkpt lat="59.1" lon="18.1"><time>2024-06-01T10:00:00+02:00</time></trkpt>
+  </trkseg><trkseg>
+    <trkpt lat="59.2" lon="18.2"></trkpt>
+  </trkseg></trk>
+  <trk><trkseg>
+    <trkpt lat="59.3" lon="18.3"><time>2024-06-01T08:30:00.500Z</time></trkpt>
+    <trkpt lat="59.4" lon="18.4"><time>2024-06-01T08:45:00Z</time></trkpt>
+  </trkseg></trk>
+</gpx>
+"""
+
+GPX_10 = """<?xml version="1.0"?>
+<gpx version="1.0" xmlns="http://www.topografix.com/GPX/1/0">
+  <trk><trkseg><trkpt lat="1.5" lon="2.5"><time>2024-06-01T00:00:00Z</time></trkpt></trkseg></trk>
+</gpx>
+"""
+
+
+@pytest.fixture
+def gpx_file(workdir):
+    path = workdir / 'user.gpx'
+    path.write_text(GPX_11)
+    return str(path)
+
+
+def test_iter_gpx_chunks_splits_into_chunks(gpx_file):
+    chunks = list(ut.iter_gpx_chunks(gpx_file, chunk_size=2))
+
+    assert [len(lats) for lats, _, _ in chunks] == [2, 2, 1]
+    lats = np.concatenate([lats for lats, _, _ in chunks])
+    np.testing.assert_array_equal(lats, [59.0, 59.1, 59.2, 59.3, 59.4])
+    assert all(lons.dtype == np.float64 and times.dtype == 'datetime64[ns]' for _, lons, times in chunks)
+
+
+def test_iter_gpx_chunks_times_are_naive_utc(gpx_file):
+    times = np.concatenate([times for _, _, times in ut.iter_gpx_chunks(gpx_file)])
+
+    assert times[0] == np.datetime64('2024-06-01T08:00:00', 'ns')
+    assert times[1] == np.datetime64('2024-06-01T08:00:00', 'ns')  # +02:00 converted to UTC
+    assert np.isnat(times[2])  # point without <time>
+    assert times[3] == np.datetime64('2024-06-01T08:30:00.500', 'ns')
+
+
+def test_parse_gpx_reads_gpx_10_and_empty_files(workdir):
+    (workdir / 'old.gpx').write_text(GPX_10)
+    (workdir / 'empty.gpx').write_text('<gpx xmlns="http://www.topografix.com/GPX/1/1"></gpx>')
+
+    df = ut.parse_gpx(str(workdir / 'old.gpx'))
+    assert df[['Latitude', 'Longitude']].values.tolist() == [[1.5, 2.5]]
+    empty = ut.parse_gpx(str(workdir / 'empty.gpx'))
+    assert empty.empty and list(empty.columns) == ['Latitude', 'Longitude', 'Time']
+    assert empty['Time'].dtype == 'datetime64[ns]'
+
+
+def test_haversine_np_matches_scalar_version():
+    rng = np.random.default_rng(0)
+    lat1, lat2 = rng.uniform(-80, 80, (2, 50))
+    lon1, lon2 = rng.uniform(-180, 180, (2, 50))
+
+    expected = [ut.haversine_distance(*args) for args in zip(lat1, lon1, lat2, lon2)]
+    np.testing.assert_allclose(ut.haversine_np(lat1, lon1, lat2, lon2), expected, rtol=1e-9)
+    assert ut.haversine_np(59.0, 18.0, 60.0, 18.0) == pytest.approx(111.195, abs=1e-3)
+    assert np.isnan(ut.haversine_np(np.nan, 18.0, 60.0, 18.0))
+
+
+def test_add_segment_columns_per_user():
+    df = pd.DataFrame({
+        'user_id': ['a', 'a', 'a', 'b', 'b'],
+        'Latitude': [59.0, 60.0, 60.0, 10.0, 10.0],
+        'Longitude': [18.0, 18.0, 18.0, 10.0, 10.0],
+        'Time': pd.to_datetime(['2024-06-01 08:00', '2024-06-01 10:00', '2024-06-01 10:00',
+                                '2024-06-01 09:00', '2024-06-01 09:30']),
+    })
+
+    df = ut.add_segment_columns(df)
+
+    first = df.index[[0, 3]]
+    assert df.loc[first, ['Distance', 'TimeDelta', 'Speed']].isna().all().all()
+    assert df.loc[1, 'Distance'] == pytest.approx(111.195, abs=1e-3)
+    assert df.loc[1, 'TimeDelta'] == 2
+    assert df.loc[1, 'Speed'] == pytest.approx(55.598, abs=1e-3)
+    assert df.loc[2, 'Distance'] == 0 and df.loc[2, 'TimeDelta'] == 0 and np.isnan(df.loc[2, 'Speed'])
+    assert df.loc[4, 'Distance'] == 0 and df.loc[4, 'TimeDelta'] == 0.5 and df.loc[4, 'Speed'] == 0
+
+
+@pytest.fixture
+def points():
+    return pd.DataFrame({
+        'user_id': ['a', 'a', 'a', 'a', 'b', 'b'],
+        'Time': pd.to_datetime(['2024-06-01 08:00', '2024-06-01 09:30', '2024-06-01 10:00', None,
+                                '2024-06-01 12:00', '2024-06-01 15:00']),
+    })
+
+
+def test_window_from_anchor_per_user_first_point(points):
+    window = ut.window_from_anchor(points, '2h')
+
+    assert window.index.tolist() == [0, 1, 2, 4]  # end inclusive, NaT dropped
+
+
+def test_window_from_anchor_fixed_timestamp(points):
+    window = ut.window_from_anchor(points, '3h', anchor='2024-06-01 09:00')
+
+    assert window.index.tolist() == [1, 2, 4]
+
+
+def test_time_windows_tumbling(points):
+    windows = ut.time_windows(points, '1h')
+
+    assert windows.index.tolist() == [0, 1, 2, 4, 5]
+    assert windows['window'].tolist() == [0, 1, 2, 0, 3]
+    assert windows['window_start'].tolist() == list(pd.to_datetime([
+        '2024-06-01 08:00', '2024-06-01 09:00', '2024-06-01 10:00', '2024-06-01 12:00', '2024-06-01 15:00']))
+
+
+def test_time_windows_sliding_repeats_rows(points):
+    windows = ut.time_windows(points, '2h', step='1h')
+
+    assert list(zip(windows.index, windows['window'])) == [
+        (0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (4, 0), (5, 2), (5, 3)]
+    starts = windows['window_start'] - windows['Time'].groupby(windows['user_id']).transform('min')
+    assert (starts == pd.to_timedelta(windows['window'], unit='h')).all()